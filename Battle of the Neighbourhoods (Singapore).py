@@ -1,24 +1,40 @@
 # %%
 # Import libraries
+import hashlib
+import json
 import math
+import multiprocessing
 import os
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import closing
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 import branca.colormap as cmp
 import folium
 import geopandas as gpd
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 import requests
+import shapely
 from branca.element import MacroElement, Template
 from bs4 import BeautifulSoup
 from folium.plugins import HeatMap
 from geopy.geocoders import (
     Nominatim,
 )  # module to convert an address into latitude and longitude values
+from geopy.exc import GeocoderServiceError
 from IPython import get_ipython
+from pandas.api.types import union_categoricals
+from requests.adapters import HTTPAdapter
 from shapely.geometry import Point
-from shapely.geometry.collection import GeometryCollection
-from shapely.geometry.multipolygon import MultiPolygon
+from shapely.strtree import STRtree
 from sklearn.cluster import KMeans
 from sklearn.impute import KNNImputer
 from sklearn.metrics import silhouette_score
@@ -31,29 +47,106 @@ subzone_geo = (
     r"master-plan-2019-subzone-boundary-no-sea-kml.geojson"  # Subzone boundaries
 )
 
-# Planning Area GeoDataFrame
-plan_geodata = gpd.read_file(planarea_geo)
-plan_geodf = plan_geodata[["name", "id", "geometry"]]
-plan_geodf = plan_geodf.rename(columns={"name": "Planning Area"})
+GEO_CACHE_DIR = "geo_cache"  # Prepared GeoDataFrames, keyed on the source file hash
 
-# Converting GeometryCollection to Multipolygon to support Planning Areas with islands
-plan_geodf["geometry"] = [
-    MultiPolygon([feature]) if isinstance(feature, GeometryCollection) else feature
-    for feature in plan_geodf["geometry"]
-]  # Required or else highlight function may not work
+try:  # Arrow-backed boundary reader (optional, needs pyogrio and pyarrow)
+    import pyarrow  # noqa: F401
+    import pyogrio  # noqa: F401
+
+    ARROW_READER = True
+except ImportError:
+    ARROW_READER = False
+
+
+def file_hash(path):
+    """Returns the SHA-256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def read_boundaries(path, columns):
+    """Reads only the given attribute columns and geometry of a boundary file, through the Arrow-backed pyogrio reader when available"""
+    if ARROW_READER:
+        return gpd.read_file(path, engine="pyogrio", use_arrow=True, columns=columns)
+
+    return gpd.read_file(path)[columns + ["geometry"]]
+
+
+def fix_collections(geoms):
+    """Converts GeometryCollections of polygons into MultiPolygons, as one vectorized pass"""
+    geoms = np.asarray(geoms, dtype=object).copy()
+    is_collection = shapely.get_type_id(geoms) == 7  # GeometryCollection
+    if is_collection.any():
+        # Polygons of each collection (nested MultiPolygons exploded as well)
+        parts, part_geom = shapely.get_parts(geoms[is_collection], return_index=True)
+        polygons, polygon_part = shapely.get_parts(parts, return_index=True)
+        is_polygon = shapely.get_type_id(polygons) == 3
+        geoms[is_collection] = shapely.multipolygons(
+            polygons[is_polygon],
+            indices=part_geom[polygon_part][is_polygon],
+            out=np.empty(is_collection.sum(), dtype=object),
+        )
+
+    return geoms
+
+
+def prepare_plan_geodf(path):
+    """Reads the Planning Area boundaries into a GeoDataFrame"""
+    plan_geodf = read_boundaries(path, ["name", "id"])
+    plan_geodf = plan_geodf.rename(columns={"name": "Planning Area"})
+
+    # Converting GeometryCollection to Multipolygon to support Planning Areas with islands
+    # Required or else highlight function may not work
+    plan_geodf["geometry"] = fix_collections(plan_geodf["geometry"])
+
+    return plan_geodf
+
+
+def prepare_sub_geodf(path):
+    """Reads the Subzone boundaries into a GeoDataFrame"""
+    # Only the name columns are parsed, not the large KML description blobs
+    sub_geodf = read_boundaries(path, ["SUBZONE_N", "PLN_AREA_N"])
+    sub_geodf = sub_geodf.rename(
+        columns={"SUBZONE_N": "Subzone", "PLN_AREA_N": "Planning Area"}
+    )
+
+    # Converting GeometryCollection to Multipolygon to support Subzones with islands
+    # Required or else highlight function may not work
+    sub_geodf["geometry"] = fix_collections(sub_geodf["geometry"])
+
+    return sub_geodf
+
+
+def load_prepared_geodf(path, prepare):
+    """Returns prepare(path), loaded from a GeoParquet cache keyed on the content hash of path when available"""
+    cache_file = os.path.join(
+        GEO_CACHE_DIR,
+        "{}-{}-{}.parquet".format(
+            os.path.splitext(os.path.basename(path))[0],
+            prepare.__name__,
+            file_hash(path)[:16],
+        ),
+    )
+    if os.path.exists(cache_file):
+        return gpd.read_parquet(cache_file, memory_map=True)
+
+    geodf = prepare(path)
+    os.makedirs(GEO_CACHE_DIR, exist_ok=True)
+    geodf.to_parquet(cache_file + ".tmp")
+    os.replace(cache_file + ".tmp", cache_file)
+
+    return geodf
 
-# Subzone GeoDataFrame
-sub_geodata = gpd.read_file(subzone_geo)
-sub_geodf = sub_geodata[["SUBZONE_N", "PLN_AREA_N", "geometry"]]
-sub_geodf = sub_geodf.rename(
-    columns={"SUBZONE_N": "Subzone", "PLN_AREA_N": "Planning Area"}
-)
 
-# Converting GeometryCollection to Multipolygon to support Subzones with islands
-sub_geodf["geometry"] = [
-    MultiPolygon([feature]) if isinstance(feature, GeometryCollection) else feature
-    for feature in sub_geodf["geometry"]
-]  # Required or else highlight function may not work
+# Planning Area GeoDataFrame
+plan_geodf = load_prepared_geodf(planarea_geo, prepare_plan_geodf)
+
+# Subzone GeoDataFrame
+sub_geodf = load_prepared_geodf(subzone_geo, prepare_sub_geodf)
 
 # %%
 # Map Functions
@@ -365,38 +458,582 @@ selected_sub_macro = MacroElement()
 selected_sub_macro._template = Template(selected_sub_template)
 
 # %%
-# Plotting Planning Area and Subzones on Map
-m = folium.Map(location=[1.3521, 103.8198], tiles="cartodbpositron", zoom_start=11)
+# Boundary layer export
+# "topojson" simplifies geometry for one zoom level while preserving topology, quantizes
+# coordinates and stores shared Subzone/Planning Area borders once as arcs. Each layer is
+# simplified once, for the zoom passed to boundary_layer/choropleth_layer (MAP_ZOOM unless
+# given), independently of the zoom a MapView opens at, so it coarsens when zoomed in past it.
+# folium.TopoJson has no highlight, so this mode also drops highlight_function from every
+# Subzone layer, choropleths included
+MAP_LAYER_FORMAT = "geojson"  # "geojson" (full resolution) or "topojson"
+MAP_ZOOM = 11  # Default zoom for simplification, and the default zoom maps open at
+TOPO_QUANTIZATION = 1e5  # Grid steps per axis for the quantized coordinates
+
+# Export mode: maps are saved to MAP_ASSET_DIR (e.g. "maps") and every distinct geometry layer
+# is written once to MAP_ASSET_DIR/assets, loaded by the maps instead of embedded (overrides
+# MAP_LAYER_FORMAT)
+MAP_ASSET_DIR = None
+map_assets = {}  # Geometry hash -> assets written for it
+
+try:  # Optional, only needed for MAP_LAYER_FORMAT = "topojson"
+    import topojson
+except ImportError:
+    topojson = None
+
+
+def zoom_tolerance(zoom, pixels=0.5):
+    """Returns the size in degrees of a number of screen pixels at a zoom level (256px tiles)"""
+    return pixels * 360 / (256 * 2 ** zoom)
+
+
+def to_topojson(geodf, zoom=MAP_ZOOM, quantization=TOPO_QUANTIZATION):
+    """Converts geodf into quantized shared-arc TopoJSON (object "data"), simplified for a zoom level"""
+    topology = topojson.Topology(
+        geodf,
+        object_name="data",
+        prequantize=quantization,
+        toposimplify=zoom_tolerance(zoom),
+        prevent_oversimplify=True,
+    )
+    return json.loads(topology.to_json())
+
+
+def shared_asset(geodf, name):
+    """Writes geodf to a sidecar GeoJSON under MAP_ASSET_DIR, shared by every layer with the same geometry, and returns its file path and relative url"""
+    geom_hash = hashlib.sha256(b"".join(shapely.to_wkb(geodf["geometry"].values)))
+    props = pd.DataFrame(geodf.drop(columns="geometry")).reset_index(drop=True)
+
+    # Reusing an asset with the same geometry whose common properties agree, adding new properties
+    for asset in map_assets.setdefault(geom_hash.hexdigest(), []):
+        common = props.columns.intersection(asset["properties"].columns)
+        if props[common].equals(asset["properties"][common]):
+            new_cols = props.columns.difference(asset["properties"].columns)
+            if len(new_cols) == 0:
+                return asset["path"], asset["url"]
+            props = asset["properties"].join(props[new_cols])
+            break
+    else:
+        slug = re.sub(r"\W+", "-", name.lower()).strip("-")
+        asset = {"url": "assets/{}-{}.geojson".format(slug, geom_hash.hexdigest()[:12])}
+        asset["path"] = os.path.join(MAP_ASSET_DIR, asset["url"])
+        map_assets[geom_hash.hexdigest()].append(asset)
+
+    asset["properties"] = props
+    os.makedirs(os.path.dirname(asset["path"]), exist_ok=True)
+    with open(asset["path"], "w") as f:
+        f.write(gpd.GeoDataFrame(props, geometry=geodf["geometry"].values).to_json())
+
+    return asset["path"], asset["url"]
+
+
+# Client-side style reading the per-feature 'style' property written by style_properties,
+# passed as boundary_layer(..., style=PROPERTY_STYLE) instead of a Python style_function
+PROPERTY_STYLE = folium.JsCode("function(feature) { return feature.properties.style; }")
+
+
+def style_properties(geodf, **style):
+    """Returns a copy of geodf with a 'style' property per feature, built in one pass from scalar or per-row (Series aligned on geodf) style values"""
+    styles = pd.DataFrame(style, index=geodf.index)
+    styled = geodf.copy()
+    styled["style"] = styles.to_dict("records")
+    return styled
+
+
+def boundary_layer(geodf, zoom=MAP_ZOOM, **kwargs):
+    """Builds a folium.GeoJson layer, a folium.TopoJson layer simplified for zoom in topojson format, or a layer loading a shared asset in export mode"""
+    if MAP_ASSET_DIR:
+        path, url = shared_asset(geodf, kwargs.get("name") or "layer")
+        layer = folium.GeoJson(path, embed=False, **kwargs)
+        layer.embed_link = url  # Relative to the saved map
+        return layer
+    if MAP_LAYER_FORMAT == "topojson":
+        kwargs.pop("highlight_function", None)  # Not supported by folium.TopoJson
+        # folium.TopoJson always styles from the 'style' property
+        style = kwargs.pop("style", None)
+        if isinstance(style, dict):
+            geodf = style_properties(geodf, **style)
+        return folium.TopoJson(to_topojson(geodf, zoom), "objects.data", **kwargs)
+
+    return folium.GeoJson(geodf, **kwargs)
+
+
+def choropleth_layer(
+    geodf, tooltip=None, highlight_function=None, zoom=MAP_ZOOM, **kwargs
+):
+    """Builds a folium.Choropleth layer carrying its own tooltip and highlight, in the same format as boundary_layer"""
+    if MAP_ASSET_DIR:
+        path, url = shared_asset(geodf, kwargs.get("name") or "choropleth")
+        choropleth = folium.Choropleth(path, **kwargs)
+        choropleth.geojson.embed = False
+        choropleth.geojson.embed_link = url
+    elif MAP_LAYER_FORMAT == "topojson":
+        # Keeping only the properties used by the key and tooltip
+        keep = [kwargs["key_on"].split(".")[-1]] + (tooltip.fields if tooltip else [])
+        topo = to_topojson(geodf[list(dict.fromkeys(keep)) + ["geometry"]], zoom)
+        choropleth = folium.Choropleth(topo, topojson="objects.data", **kwargs)
+        highlight_function = None  # Not supported by folium.TopoJson
+    else:
+        choropleth = folium.Choropleth(geodf, **kwargs)
+
+    if tooltip is not None:
+        choropleth.geojson.add_child(tooltip)
+    if highlight_function is not None:
+        choropleth.geojson.highlight = True
+        choropleth.geojson.highlight_function = highlight_function
+
+    return choropleth
 
+
+# %%
+# Map Composition
+# Maps are MapViews: lists of named layers registered with register_layer. Each layer is built
+# once, on first use, and shared by every view containing it. A view only creates its folium.Map
+# when displayed or saved, attaching the shared layers to it just before rendering. Builders
+# bind their data as default arguments, so a layer embeds the data as of its own cell, whenever
+# it is first built
+map_layers = {}  # Layer name -> builder returning a folium element
+built_layers = {}  # Layer name -> built folium element
+map_views = {}  # View name -> MapView, in display order
+
+
+def register_layer(name, build):
+    """Registers the builder of a named map layer, replacing any layer already built under that name"""
+    map_layers[name] = build
+    built_layers.pop(name, None)
+
+
+def get_layer(name):
+    """Returns the named map layer, building it on first use"""
+    if name not in built_layers:
+        built_layers[name] = map_layers[name]()
+    return built_layers[name]
+
+
+class MapView:
+    """folium.Map composed of named map layers, built lazily when displayed or saved"""
+
+    def __init__(self, *layers, location=(1.3521, 103.8198), zoom_start=MAP_ZOOM):
+        self.layers = list(layers)
+        self.map_kwargs = {
+            "location": list(location),
+            "tiles": "cartodbpositron",
+            "zoom_start": zoom_start,
+            "prefer_canvas": True,
+        }
+
+    def add(self, *layers):
+        """Adds named layers to the view"""
+        self.layers.extend(layers)
+        return self
+
+    def _build(self):
+        """Returns a new folium.Map with the view's layers attached (layers are shared between views, so only use it to save or display at once)"""
+        view = folium.Map(**self.map_kwargs)
+        for name in self.layers:
+            view.add_child(get_layer(name))
+        return view
+
+    def save(self, path):
+        """Saves the view to an HTML file"""
+        self._build().save(path)
+
+    def _repr_html_(self):
+        return self._build()._repr_html_()
+
+
+# %%
+# Plotting Planning Area and Subzones on Map
 # Subzone Boundaries
-sub_border = folium.GeoJson(
-    sub_geodf,
-    name="Subzone Borders",
-    style_function=sub_style_function,
-    highlight_function=highlight_function,
-    tooltip=folium.GeoJsonTooltip(
-        fields=["Subzone", "Planning Area"],
-        aliases=["Subzone: ", "Planning Area: "],
-        style=(
-            "background-color: white; color: #333333; font-family: arial; font-size: 12px; padding: 10px;"
+register_layer(
+    "sub_border",
+    lambda geodf=sub_geodf.copy(): boundary_layer(
+        geodf,
+        name="Subzone Borders",
+        style_function=sub_style_function,
+        highlight_function=highlight_function,
+        tooltip=folium.GeoJsonTooltip(
+            fields=["Subzone", "Planning Area"],
+            aliases=["Subzone: ", "Planning Area: "],
+            style=(
+                "background-color: white; color: #333333; font-family: arial; font-size: 12px; padding: 10px;"
+            ),
         ),
     ),
 )
 
 # Planning Area Boundaries
-plan_border = folium.GeoJson(
-    plan_geodf, name="Planning Area Borders", style_function=plan_style_function,
+register_layer(
+    "plan_border",
+    lambda geodf=plan_geodf.copy(): boundary_layer(
+        geodf, name="Planning Area Borders", style_function=plan_style_function,
+    ),
 )
 
-sub_border.add_to(m)
-plan_border.add_to(m)
+# Legends and layer controls
+register_layer("bubble_legend", lambda macro=bubble_macro: macro)
+register_layer("mrt_mall_legend", lambda macro=mrt_mall_macro: macro)
+register_layer("selected_sub_legend", lambda macro=selected_sub_macro: macro)
+register_layer("layer_control", folium.LayerControl)
+
+m = map_views["subzones"] = MapView("sub_border", "plan_border")
 
 m
 
+# %%
+# On-disk HTTP response cache
+# Responses are keyed on the normalised url with credentials removed
+HTTP_CACHE_DIR = "http_cache"
+# "cache", "record" (always refetch), "replay" (recorded only, no network) or "off"
+HTTP_CACHE_MODE = "cache"
+HTTP_CACHE_TTL = {  # Seconds, matched on host + path prefix
+    "api.foursquare.com/v2/venues/search": 7 * 24 * 3600,
+    "xingfutangsg.com": 24 * 3600,
+}
+HTTP_CACHE_DEFAULT_TTL = 24 * 3600
+CREDENTIAL_PARAMS = {"client_id", "client_secret", "oauth_token"}
+
+
+def normalize_url(url):
+    """Lowercases scheme/host, drops credentials and fragment, and sorts query parameters"""
+    parts = urlsplit(url)
+    query = sorted(
+        (key, value)
+        for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key not in CREDENTIAL_PARAMS
+    )
+    path = parts.path.rstrip("/")
+    return urlunsplit(
+        (parts.scheme.lower(), parts.netloc.lower(), path, urlencode(query), "")
+    )
+
+
+def cache_path(url):
+    """Returns the cache file path of a url"""
+    key = hashlib.sha256(normalize_url(url).encode()).hexdigest()
+    return os.path.join(HTTP_CACHE_DIR, key + ".json")
+
+
+def cache_ttl(url):
+    """Returns the TTL in seconds of the endpoint a url belongs to"""
+    parts = urlsplit(normalize_url(url))
+    endpoint = parts.netloc + parts.path
+    for prefix, ttl in HTTP_CACHE_TTL.items():
+        if endpoint.startswith(prefix):
+            return ttl
+
+    return HTTP_CACHE_DEFAULT_TTL
+
+
+def cache_load(url):
+    """Returns the cached body of a url, or None if it has to be fetched"""
+    if HTTP_CACHE_MODE in ("off", "record"):
+        return None
+
+    path = cache_path(url)
+    if not os.path.exists(path):
+        if HTTP_CACHE_MODE == "replay":
+            raise LookupError("No recorded response for {}".format(normalize_url(url)))
+        return None
+
+    with open(path, encoding="utf-8") as f:
+        entry = json.load(f)
+    expired = time.time() - entry["fetched_at"] > cache_ttl(url)
+    if HTTP_CACHE_MODE == "cache" and expired:
+        return None
+
+    return entry["body"]
+
+
+def cache_store(url, body):
+    """Records the body of a url (never the credentials) in the cache"""
+    if HTTP_CACHE_MODE == "off":
+        return
+
+    os.makedirs(HTTP_CACHE_DIR, exist_ok=True)
+    path = cache_path(url)
+    entry = {"url": normalize_url(url), "fetched_at": time.time(), "body": body}
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(entry, f)
+    os.replace(path + ".tmp", path)
+
+
+# %%
+# HTTP fetcher
+# Runs Foursquare searches and scrapes concurrently over a shared keep-alive pool,
+# with rate limiting and retries
+FSQ_CONCURRENCY = 8  # Maximum number of requests in flight
+FSQ_RATE_LIMIT = 5  # Maximum requests per second
+FSQ_MAX_RETRIES = 5  # Retries on 429/5xx responses and connection errors
+FSQ_BACKOFF = 0.5  # Base delay in seconds, doubled on every retry
+FSQ_TIMEOUT = 30  # Seconds
+
+
+class RateLimiter:
+    """Thread-safe limiter spacing calls at least 1/rate seconds apart"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_time)
+            self.next_time = slot + self.interval
+        time.sleep(slot - now)
+
+    def pause_until(self, timestamp):
+        """Holds back every caller until a Unix timestamp (e.g. quota reset)"""
+        with self.lock:
+            resume = time.monotonic() + max(0, timestamp - time.time())
+            self.next_time = max(self.next_time, resume)
+
+
+def get_with_retry(session, url, limiter):
+    """GETs a url and returns its body, retrying 429/5xx responses and connection errors with jittered exponential backoff"""
+    for attempt in range(FSQ_MAX_RETRIES + 1):
+        limiter.wait()
+        try:
+            response = session.get(url, timeout=FSQ_TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == FSQ_MAX_RETRIES:
+                raise
+            retry_after = None
+        else:
+            # Foursquare reports the hourly quota in the response headers
+            if response.headers.get("X-RateLimit-Remaining") == "0":
+                limiter.pause_until(
+                    float(response.headers.get("X-RateLimit-Reset", time.time()))
+                )
+            if response.status_code != 429 and response.status_code < 500:
+                response.raise_for_status()
+                return response.text
+            if attempt == FSQ_MAX_RETRIES:
+                response.raise_for_status()
+            retry_after = response.headers.get("Retry-After")
+
+        delay = FSQ_BACKOFF * 2 ** attempt
+        if retry_after is not None and retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        time.sleep(delay + random.uniform(0, delay))  # Full jitter
+
+
+def fetch_all_text(urls, concurrency=FSQ_CONCURRENCY, rate=FSQ_RATE_LIMIT):
+    """Fetches a list of urls concurrently, serving cached responses first, and returns the bodies in the same order"""
+    bodies = [cache_load(url) for url in urls]
+    missing = [i for i, body in enumerate(bodies) if body is None]
+    if not missing:
+        return bodies
+
+    limiter = RateLimiter(rate)
+    with requests.Session() as session:
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        session.mount("https://", adapter)
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            fetched = pool.map(
+                lambda i: get_with_retry(session, urls[i], limiter), missing
+            )
+            for i, body in zip(missing, fetched):
+                cache_store(urls[i], body)
+                bodies[i] = body
+
+    return bodies
+
+
+def fetch_all_json(urls, concurrency=FSQ_CONCURRENCY, rate=FSQ_RATE_LIMIT):
+    """Fetches a list of JSON urls concurrently and returns the parsed results in the same order"""
+    return [json.loads(body) for body in fetch_all_text(urls, concurrency, rate)]
+
+
+# %%
+# Batch geocoder with SQLite cache
+# Only addresses missing from the cache reach Nominatim, through one rate-limited client
+GEOCODE_DB = "geocode_cache.sqlite"
+GEOCODE_RATE_LIMIT = 1  # Nominatim usage policy: max 1 request per second
+GEOCODE_MISS_TTL = 30 * 24 * 3600  # Seconds before a not-found address is retried
+
+
+def normalize_address(address):
+    """Uppercases an address and collapses commas and whitespace"""
+    return " ".join(address.upper().replace(",", " ").split())
+
+
+def geocode_addresses(
+    addresses, db_path=GEOCODE_DB, suffix=" Singapore", refresh=False
+):
+    """Geocodes a list of addresses into (lat, lng) tuples (None if not found), caching results in SQLite under their normalised form (refresh=True geocodes everything again)"""
+    keys = [normalize_address(address) for address in addresses]
+
+    with closing(sqlite3.connect(db_path)) as conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS geocode "
+            "(address TEXT PRIMARY KEY, lat REAL, lng REAL, geocoded_at REAL)"
+        )
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(geocode)")]
+        if "geocoded_at" not in columns:  # Caches written before misses expired
+            conn.execute("ALTER TABLE geocode ADD COLUMN geocoded_at REAL")
+
+        # Original address text of each key, sent to Nominatim as written
+        queries = dict(zip(reversed(keys), reversed(addresses)))
+        unique_keys = list(dict.fromkeys(keys))
+        cached = {}
+        for i in range(0, len(unique_keys), 500):  # SQLite host parameter limit
+            chunk = unique_keys[i : i + 500]
+            rows = conn.execute(
+                "SELECT address, lat, lng, geocoded_at FROM geocode "
+                "WHERE address IN ({})".format(",".join("?" * len(chunk))),
+                chunk,
+            )
+            for key, lat, lng, geocoded_at in rows:
+                if lat is not None:
+                    cached[key] = (lat, lng)
+                elif time.time() - (geocoded_at or 0) < GEOCODE_MISS_TTL:
+                    cached[key] = None
+
+        missing = [key for key in unique_keys if refresh or key not in cached]
+        if missing:
+            geolocator = Nominatim(user_agent="foursquare_agent")
+            limiter = RateLimiter(GEOCODE_RATE_LIMIT)
+            for key in missing:
+                limiter.wait()
+                try:
+                    location = geolocator.geocode(queries[key] + suffix)
+                except GeocoderServiceError as e:  # Not cached, retried next run
+                    print("Geocoding failed for {}: {}".format(queries[key], e))
+                    continue
+                if location is None:
+                    cached[key] = None
+                else:
+                    cached[key] = (location.latitude, location.longitude)
+                with conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?)",
+                        (key,) + (cached[key] or (None, None)) + (time.time(),),
+                    )
+
+    return [cached.get(key) for key in keys]
+
+
+# %%
+# Offline gazetteer geocoder backed by a local postal code/building index
+# Resolves addresses without network access: exact postal code, then block + fuzzy street name, then building name
+GEOCODER = "nominatim"  # "nominatim" or "gazetteer" (offline)
+# Columns: postal_code, building, block, street, lat, lng
+GAZETTEER_CSV = "sg_postal_buildings.csv"
+STREET_ABBREVIATIONS = {
+    "AVE": "AVENUE",
+    "BLVD": "BOULEVARD",
+    "BT": "BUKIT",
+    "CL": "CLOSE",
+    "CRES": "CRESCENT",
+    "CTR": "CENTRE",
+    "CTRL": "CENTRAL",
+    "DR": "DRIVE",
+    "JLN": "JALAN",
+    "KG": "KAMPONG",
+    "LOR": "LORONG",
+    "NTH": "NORTH",
+    "PL": "PLACE",
+    "RD": "ROAD",
+    "ST": "STREET",
+    "STH": "SOUTH",
+    "TG": "TANJONG",
+    "UPP": "UPPER",
+}
+
+
+def normalize_street(street):
+    """Uppercases a street name, strips punctuation and expands common abbreviations"""
+    words = re.sub(r"[^A-Z0-9 ]", " ", street.upper()).split()
+    return " ".join(STREET_ABBREVIATIONS.get(word, word) for word in words)
+
+
+class Gazetteer:
+    """In-memory postal code, building and street name (trie) index of a Singapore address CSV"""
+
+    def __init__(self, csv_path):
+        df = pd.read_csv(
+            csv_path,
+            dtype={"postal_code": str, "building": str, "block": str, "street": str},
+        )
+        coords = list(zip(df["lat"], df["lng"]))
+        self.postal = dict(zip(df["postal_code"].str.zfill(6), coords))
+        self.buildings = {
+            normalize_address(building): coord
+            for building, coord in zip(df["building"], coords)
+            if isinstance(building, str)
+        }
+
+        # Character trie of street names, leaves ("$") map block number to coords
+        self.trie = {}
+        for block, street, coord in zip(df["block"], df["street"], coords):
+            if not isinstance(street, str):
+                continue
+            node = self.trie
+            for char in normalize_street(street):
+                node = node.setdefault(char, {})
+            node.setdefault("$", {})[str(block).upper()] = coord
+
+    def search_street(self, street, max_dist=2):
+        """Returns the blocks of the closest street name within max_dist edits (None if no match)"""
+        word = normalize_street(street)
+        best = [max_dist + 1, None]
+
+        def walk(node, char, prev_row):
+            # One row of the Levenshtein matrix per trie level
+            row = [prev_row[0] + 1]
+            for i in range(1, len(word) + 1):
+                substitution = prev_row[i - 1] + (word[i - 1] != char)
+                row.append(min(row[i - 1] + 1, prev_row[i] + 1, substitution))
+            if "$" in node and row[-1] < best[0]:
+                best[:] = [row[-1], node["$"]]
+            if min(row) < best[0]:
+                for next_char, child in node.items():
+                    if next_char != "$":
+                        walk(child, next_char, row)
+
+        first_row = list(range(len(word) + 1))
+        for char, child in self.trie.items():
+            walk(child, char, first_row)
+
+        return best[1]
+
+    def geocode(self, address):
+        """Returns the (lat, lng) of an address, or None if it is not in the index"""
+        address = address.upper()
+        postal = re.search(r"(?<!\d)(\d{6})(?!\d)", address)
+        if postal and postal.group(1) in self.postal:
+            return self.postal[postal.group(1)]
+
+        # Unit numbers (#01-10) and trailing "SINGAPORE 123456" are not part of a street
+        segments = [
+            re.sub(r"\s*\bSINGAPORE\s*\d{6}$", "", segment.strip())
+            for segment in re.split(r"[,|]", re.sub(r"#[^\s,|]+", " ", address))
+        ]
+        for segment in segments:
+            block_street = re.match(
+                r"(?:BLK\s*|BLOCK\s*)?(\d+[A-Z]?)\s+(\D.*)$", segment
+            )
+            if block_street:
+                blocks = self.search_street(block_street.group(2))
+                if blocks:
+                    if block_street.group(1) in blocks:
+                        return blocks[block_street.group(1)]
+                    # Unknown block, fall back to the street centroid
+                    lat, lng = np.mean(list(blocks.values()), axis=0)
+                    return (float(lat), float(lng))
+        for segment in segments:
+            if normalize_address(segment) in self.buildings:
+                return self.buildings[normalize_address(segment)]
+
+        return None
+
+
 # %%
 # Xing Fu Tang (Singapore) Locations
 # Scraping addresses from official website
-xft_get = requests.get("https://xingfutangsg.com").text
+(xft_get,) = fetch_all_text(["https://xingfutangsg.com"])
 soup = BeautifulSoup(xft_get, "html.parser")
 xft_add_raw = soup.find_all(class_="vc-hoverbox-block-inner vc-hoverbox-back-inner")
 
@@ -409,14 +1046,19 @@ for add in xft_add_raw:
     add_temp = add_temp.split("| ")
     xft_add.append(add_temp[0])
 
-# Setting Nominatim coords into lists
-xft_lat = []
-xft_lng = []
-for add in xft_add:
-    geolocator = Nominatim(user_agent="foursquare_agent")
-    location = geolocator.geocode("{} Singapore".format(add))
-    xft_lat.append(location.latitude)
-    xft_lng.append(location.longitude)
+# Setting coords into lists, dropping addresses that could not be geocoded
+if GEOCODER == "gazetteer":
+    gazetteer = Gazetteer(GAZETTEER_CSV)
+    xft_coords = [gazetteer.geocode(add) for add in xft_add]
+else:
+    xft_coords = geocode_addresses(xft_add)
+for add, coords in zip(xft_add, xft_coords):
+    if coords is None:
+        print("Address not found: {}".format(add))
+
+xft_add = [add for add, coords in zip(xft_add, xft_coords) if coords is not None]
+xft_lat = [coords[0] for coords in xft_coords if coords is not None]
+xft_lng = [coords[1] for coords in xft_coords if coords is not None]
 
 xft_add
 
@@ -430,6 +1072,141 @@ CLIENT_ID = os.getenv("CLIENT_ID")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET")
 ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
 
+# %%
+# Streaming venue normalizer
+# Pulls only the needed fields from the Foursquare JSON, filtering and deduping while streaming
+VENUE_COLUMNS = [
+    "id",
+    "name",
+    "location.lat",
+    "location.lng",
+    "location.country",
+    "cat_id",
+    "cat_name",
+]
+
+
+def iter_venues(results, categories, country="Singapore"):
+    """Yields one record per venue in the search results whose primary category is in categories, skipping other countries and repeated IDs"""
+    seen = set()
+    for result in results:
+        for venue in result["response"]["venues"]:
+            location = venue.get("location", {})
+            if venue["id"] in seen or country not in location.get("country", ""):
+                continue
+
+            venue_categories = venue.get("categories") or [{}]
+            primary = next(
+                (cat for cat in venue_categories if cat.get("primary")),
+                venue_categories[0],
+            )
+            if primary.get("name") not in categories:
+                continue
+
+            seen.add(venue["id"])
+            yield (
+                venue["id"],
+                venue.get("name"),
+                location.get("lat"),
+                location.get("lng"),
+                location.get("country"),
+                primary.get("id"),
+                primary.get("name"),
+            )
+
+
+def venues_frame(results, categories, country="Singapore"):
+    """Builds the venue DataFrame once from a stream of search results"""
+    return pd.DataFrame.from_records(
+        iter_venues(results, categories, country), columns=VENUE_COLUMNS
+    )
+
+
+# %%
+# Adaptive tiled venue search
+# Splits Singapore into cells queried in parallel, subdividing any cell whose results hit the cap
+SEARCH_MODE = "near"  # "near" (single query) or "tiled"
+SG_BOUNDS = (1.15, 103.6, 1.48, 104.1)  # South, West, North, East
+TILE_GRID = 4  # Initial cells per side
+TILE_MAX_DEPTH = 4  # Maximum number of times a cell is split in four
+FSQ_RESULT_CAP = 50  # Foursquare returns at most 50 venues per search
+truncated_cells = []  # (params, cell) still at the cap at max depth, maybe truncated
+
+
+def search_url(params, cell):
+    """Returns the Foursquare venues/search url of params restricted to a (south, west, north, east) cell"""
+    south, west, north, east = cell
+    query = {
+        "client_id": CLIENT_ID,
+        "client_secret": CLIENT_SECRET,
+        "oauth_token": ACCESS_TOKEN,
+        "v": VERSION,
+        "intent": "browse",
+        "sw": "{},{}".format(south, west),
+        "ne": "{},{}".format(north, east),
+        "limit": FSQ_RESULT_CAP,
+        **params,
+    }
+    return "https://api.foursquare.com/v2/venues/search?" + urlencode(query)
+
+
+def split_cell(cell):
+    """Splits a (south, west, north, east) cell into four quadrants"""
+    south, west, north, east = cell
+    mid_lat, mid_lng = (south + north) / 2, (west + east) / 2
+    return [
+        (south, west, mid_lat, mid_lng),
+        (south, mid_lng, mid_lat, east),
+        (mid_lat, west, north, mid_lng),
+        (mid_lat, mid_lng, north, east),
+    ]
+
+
+def tiled_search(
+    param_list, bounds=SG_BOUNDS, grid=TILE_GRID, max_depth=TILE_MAX_DEPTH
+):
+    """Runs every search in param_list over a grid of cells, one parallel batch per subdivision level, and returns all results"""
+    south, west, north, east = bounds
+    lat_edges = np.linspace(south, north, grid + 1)
+    lng_edges = np.linspace(west, east, grid + 1)
+    cells = [
+        (lat_edges[i], lng_edges[j], lat_edges[i + 1], lng_edges[j + 1])
+        for i in range(grid)
+        for j in range(grid)
+    ]
+    pending = [(params, cell) for params in param_list for cell in cells]
+
+    results = []
+    for depth in range(max_depth + 1):
+        batch = fetch_all_json([search_url(params, cell) for params, cell in pending])
+        results.extend(batch)
+
+        # Only cells that hit the cap can hide more venues
+        capped = [
+            (params, cell)
+            for (params, cell), result in zip(pending, batch)
+            if len(result["response"]["venues"]) >= FSQ_RESULT_CAP
+        ]
+        if depth == max_depth and capped:
+            truncated_cells.extend(capped)
+            print(
+                "Warn: {} cells still return {} venues at max depth {}, results may be "
+                "truncated (see truncated_cells, raise TILE_MAX_DEPTH)".format(
+                    len(capped), FSQ_RESULT_CAP, max_depth
+                )
+            )
+            break
+        pending = [
+            (params, quadrant)
+            for params, cell in capped
+            for quadrant in split_cell(cell)
+        ]
+        if not pending:
+            break
+
+    return results
+
+
 # %%
 # Other Bubble Tea Locations in Singapore - Getting Data from Foursquare API
 # Define Foursquare information
@@ -454,95 +1231,252 @@ BUBBLE_CHAINS = [
 ]
 LIMIT = 200
 
-# Creating empty dataframe
-boba_df = pd.DataFrame(
-    columns=[
-        "id",
-        "name",
-        "categories",
-        "referralId",
-        "hasPerk",
-        "location.address",
-        "location.crossStreet",
-        "location.lat",
-        "location.lng",
-        "location.labeledLatLngs",
-        "location.postalCode",
-        "location.cc",
-        "location.city",
-        "location.country",
-        "location.formattedAddress",
-        "location.neighborhood",
-        "location.state",
-        "venuePage.id",
-    ]
-)
-
-for chain in BUBBLE_CHAINS:
-    boba_url = "https://api.foursquare.com/v2/venues/search?categoryId={}&client_id={}&client_secret={}&near={}&oauth_token={}&v={}&query={}&limit={}".format(
+boba_urls = [
+    "https://api.foursquare.com/v2/venues/search?categoryId={}&client_id={}&client_secret={}&near={}&oauth_token={}&v={}&query={}&limit={}".format(
         BUBBLE_ID, CLIENT_ID, CLIENT_SECRET, AREA, ACCESS_TOKEN, VERSION, chain, LIMIT,
     )
+    for chain in BUBBLE_CHAINS
+]
+
+if SEARCH_MODE == "tiled":
+    boba_results = tiled_search(
+        [{"categoryId": BUBBLE_ID, "query": chain} for chain in BUBBLE_CHAINS]
+    )
+else:
+    boba_results = fetch_all_json(boba_urls)
+
+# Keeping only Bubble Tea Shops in Singapore, deduplicated on Foursquare Place ID
+boba_df = venues_frame(boba_results, ["Bubble Tea Shop"])
+
+print(
+    "Categories of venues: {}".format(boba_df["cat_name"].unique())
+)  # Checking Categories
+boba_df
 
-    boba_results = requests.get(boba_url).json()
+# %%
+# Point Clustering
+# Layers with more than POINT_CLUSTER_THRESHOLD points are aggregated in Python into clusters
+# for every zoom level from CLUSTER_MIN_ZOOM to CLUSTER_MAX_ZOOM, in the style of supercluster:
+# each zoom merges the clusters of the zoom below it on a grid of CLUSTER_RADIUS pixels, and the
+# browser only draws the clusters of the current zoom within the view, redrawn as the map moves
+POINT_CLUSTER_THRESHOLD = 5000  # Points above which a point layer is clustered
+CLUSTER_MIN_ZOOM = 10
+CLUSTER_MAX_ZOOM = 18
+CLUSTER_RADIUS = 40  # Cluster cell size in screen pixels
+CLUSTER_PRECISION = 5  # Decimal places kept for cluster coordinates (~1m)
+CLUSTER_VIEW_PAD = 0.5  # Fraction of the view size also drawn beyond each edge
+cluster_payloads = {}  # id(features) -> (features, payload), built once per dataset
+
+
+def mercator_xy(lat_list, lng_list):
+    """Projects coordinates to Web Mercator world coordinates in [0, 1]"""
+    sin_lat = np.sin(np.radians(np.clip(lat_list, -85.0511, 85.0511)))
+    x = np.asarray(lng_list, dtype=float) / 360 + 0.5
+    y = 0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * np.pi)
+    return x, y
+
+
+def mercator_latlng(x, y):
+    """Inverts mercator_xy back to latitude and longitude"""
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y))))
+    return lat, (x - 0.5) * 360
+
+
+def build_cluster_index(
+    lat_list,
+    lng_list,
+    min_zoom=CLUSTER_MIN_ZOOM,
+    max_zoom=CLUSTER_MAX_ZOOM,
+    radius=CLUSTER_RADIUS,
+):
+    """Builds point clusters for every zoom level, each level merging the previous (finer) one, returning zoom -> (x, y, count, point index or -1 for clusters)"""
+    x, y = mercator_xy(lat_list, lng_list)
+    count = np.ones(len(x))
+    member = np.arange(len(x))
+    levels = {}
+
+    for zoom in range(max_zoom, min_zoom - 1, -1):
+        cell = radius / (256 * 2**zoom)  # Cluster cell size in world coordinates
+        n_cells = int(np.ceil(1 / cell)) + 1
+        col = np.floor(x / cell).astype(np.int64)
+        row = np.floor(y / cell).astype(np.int64)
+        _, inverse = np.unique(col * n_cells + row, return_inverse=True)
+
+        # Count-weighted cluster centers, keeping the point index of single points
+        first = np.zeros(inverse.max() + 1, dtype=np.int64)
+        first[inverse[::-1]] = np.arange(len(inverse))[::-1]
+        new_count = np.bincount(inverse, weights=count)
+        x = np.bincount(inverse, weights=x * count) / new_count
+        y = np.bincount(inverse, weights=y * count) / new_count
+        member = np.where(new_count == 1, member[first], -1)
+        count = new_count
+        levels[zoom] = (x, y, count, member)
+
+    return levels
+
+
+def cluster_payload(levels, precision=CLUSTER_PRECISION):
+    """Packs cluster levels into compact per-zoom column lists [lat, lng, count, point index]"""
+    payload = {}
+    for zoom, (x, y, count, member) in levels.items():
+        lat, lng = mercator_latlng(x, y)
+        payload[zoom] = [
+            np.round(lat, precision).tolist(),
+            np.round(lng, precision).tolist(),
+            count.astype(int).tolist(),
+            member.tolist(),
+        ]
+    return payload
+
+
+class ClusterLayer(folium.map.Layer):
+    """Leaflet layer drawing the precomputed clusters of the current zoom inside the (padded) view as CircleMarkers, scaled by point count, with popups on single points"""
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+        var {{ this.get_name() }} = L.featureGroup();
+        (function(group, map) {
+            var levels = {{ this.payload|tojson }};
+            var popups = {{ this.popups|tojson }};
+            var options = {{ this.options|tojson }};
+            var drawn = null;
+
+            function draw() {
+                var zoom = Math.min({{ this.max_zoom }}, map.getZoom());
+                zoom = Math.max({{ this.min_zoom }}, zoom);
+                var level = levels[zoom];
+                var bounds = map.getBounds().pad({{ this.pad }});
+                var view = zoom + "/" + bounds.toBBoxString();
+                if (view === drawn) {  // zoomend is followed by moveend
+                    return;
+                }
+                drawn = view;
+                var south = bounds.getSouth(), north = bounds.getNorth();
+                var west = bounds.getWest(), east = bounds.getEast();
+                group.clearLayers();
+                for (var i = 0; i < level[0].length; i++) {
+                    var lat = level[0][i], lng = level[1][i];
+                    if (lat < south || lat > north || lng < west || lng > east) {
+                        continue;
+                    }
+                    var count = level[2][i];
+                    var radius = options.radius * (1 + Math.log10(count));
+                    var marker = L.circleMarker(
+                        [lat, lng],
+                        Object.assign({}, options, {radius: radius})
+                    );
+                    if (level[3][i] >= 0) {
+                        marker.bindPopup(popups[level[3][i]]);
+                    } else {
+                        marker.bindTooltip(count + " points");
+                    }
+                    group.addLayer(marker);
+                }
+            }
+
+            map.on("zoomend moveend", draw);
+            draw();
+        })({{ this.get_name() }}, {{ this._parent.get_name() }});
+        {% endmacro %}
+        """
+    )
 
-    # Assign relevant part of JSON to venues
-    boba_venues = boba_results["response"]["venues"]
+    def __init__(self, payload, popups, name=None, **marker_kwargs):
+        super().__init__(name=name, overlay=True)
+        self._name = "ClusterLayer"
+        self.payload = payload
+        self.popups = popups
+        self.options = folium.CircleMarker(**marker_kwargs).options
+        self.pad = CLUSTER_VIEW_PAD
+        self.min_zoom = min(payload)
+        self.max_zoom = max(payload)
 
-    # Tranform venues into a dataframe
-    boba_df_temp = pd.json_normalize(boba_venues)
 
-    # Append to main dataframe
-    boba_df = boba_df.append(boba_df_temp, ignore_index=True)
+# %%
+# Point Layers
+# Every point of a layer goes into one GeoJSON FeatureCollection drawn as CircleMarkers on the
+# map's canvas renderer (prefer_canvas), with the popup text as a feature property
+def point_features(lat_list, lng_list, popup_list):
+    """Builds a GeoJSON FeatureCollection of Points, with the popup text as the 'popup' property"""
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [lng, lat]},
+                "properties": {"popup": str(popup)},
+            }
+            for lat, lng, popup in zip(
+                np.asarray(lat_list, dtype=float).tolist(),
+                np.asarray(lng_list, dtype=float).tolist(),
+                popup_list,
+            )
+        ],
+    }
 
-# Filtering results from other countries
-boba_df = boba_df[boba_df["location.country"].str.contains("Singapore")]
 
-# Filtering results that are not Bubble Tea Shops
-boba_df_cat = boba_df.categories.apply(pd.Series).iloc[:, 0].apply(pd.Series)
-boba_df_cat.rename(columns={"id": "cat_id", "name": "cat_name"}, inplace=True)
-boba_df = boba_df.join(boba_df_cat)
-boba_df = boba_df[boba_df["cat_name"] == "Bubble Tea Shop"]
+def point_layer(features, name=None, **marker_kwargs):
+    """Builds a single folium.GeoJson layer drawing features as CircleMarkers styled by marker_kwargs, with a popup from the 'popup' property, or a ClusterLayer above POINT_CLUSTER_THRESHOLD points"""
+    if not features["features"]:  # Nothing to draw (GeoJsonPopup needs a feature)
+        return folium.FeatureGroup(name=name)
+    if len(features["features"]) > POINT_CLUSTER_THRESHOLD:
+        if id(features) not in cluster_payloads:
+            coords = np.array(
+                [feature["geometry"]["coordinates"] for feature in features["features"]]
+            )
+            levels = build_cluster_index(coords[:, 1], coords[:, 0])
+            cluster_payloads[id(features)] = (features, cluster_payload(levels))
+        popups = [feature["properties"]["popup"] for feature in features["features"]]
+        payload = cluster_payloads[id(features)][1]
+        return ClusterLayer(payload, popups, name=name, **marker_kwargs)
+
+    return folium.GeoJson(
+        features,
+        name=name,
+        marker=folium.CircleMarker(**marker_kwargs),
+        popup=folium.GeoJsonPopup(fields=["popup"], labels=False),
+    )
 
-# Dropping duplicated results based on Foursquare Place ID
-boba_df.drop_duplicates(subset=["id"], inplace=True)
-boba_df.reset_index(inplace=True, drop=True)
 
-print(
-    "Categories of venues: {}".format(boba_df["cat_name"].unique())
-)  # Checking Categories
-boba_df
+boba_points = point_features(
+    boba_df["location.lat"], boba_df["location.lng"], boba_df["name"]
+)
+xft_points = point_features(
+    xft_lat, xft_lng, ["Xing Fu Tang @ {}".format(add) for add in xft_add]
+)
 
 # %%
 # Plotting Bubble Tea Outlets
 # Other Bubble Tea Outlets from Foursquare API
-for index, row in boba_df.iterrows():
-    lat = row["location.lat"]
-    lng = row["location.lng"]
-    name = row["name"]
-
-    folium.CircleMarker(
-        location=[lat, lng],
+register_layer(
+    "boba",
+    lambda features=boba_points: point_layer(
+        features,
+        name="Bubble Tea Outlets",
         radius=3,
         weight=0,
-        popup=name,
         color="Blue",
         fill_color="Blue",
         fill_opacity=0.5,
-    ).add_to(m)
+    ),
+)
 
 # Adding Xing Fu Tang Location
-for lat, lng, add in zip(xft_lat, xft_lng, xft_add):
-    folium.CircleMarker(
-        location=[lat, lng],
+register_layer(
+    "xft",
+    lambda features=xft_points: point_layer(
+        features,
+        name="Xing Fu Tang",
         radius=5,
         weight=2,
-        popup="Xing Fu Tang @ {}".format(add),
         color="Black",
         fill_color="Red",
         fill_opacity=1,
-    ).add_to(m)
+    ),
+)
 
-m.get_root().add_child(bubble_macro)
+m.add("boba", "xft", "bubble_legend")
 
 # %%
 # MRT Station Location Dataframe
@@ -550,42 +1484,139 @@ m.get_root().add_child(bubble_macro)
 mrt_df = pd.read_csv("mrt_lrt_data.csv")
 mrt_df = mrt_df[mrt_df["type"] == "MRT"]  # Filtering out other station types
 
+# %%
+# Density Rasters
+# Point densities are estimated in Python: points are binned onto a DENSITY_CELL metre grid over
+# Singapore and convolved with a Gaussian kernel by FFT, then shipped as one PNG image overlay,
+# so the map payload does not grow with the number of points
+HEATMAP_MODE = "raster"  # "raster" or "heatmap" (leaflet.heat on the raw points)
+DENSITY_CELL = 50  # Grid cell size in metres
+DENSITY_BANDWIDTH = 400  # Gaussian kernel standard deviation in metres
+DENSITY_OPACITY = 0.7
+SUBZONE_DENSITY = False  # Also average the densities per Subzone (sub_density_df)
+
+
+def density_grid(
+    lat_list, lng_list, bounds=SG_BOUNDS, cell=DENSITY_CELL, bandwidth=DENSITY_BANDWIDTH
+):
+    """Estimates the kernel density (points per km2) of coordinates on a grid over bounds, returning the grid with its bounds (row 0 is the north edge)"""
+    south, west, north, east = bounds
+    # Local equirectangular projection to metres, accurate enough at Singapore's scale
+    m_lat = 110574.0
+    m_lng = 111320.0 * np.cos(np.radians((south + north) / 2))
+    n_rows = int(np.ceil((north - south) * m_lat / cell))
+    n_cols = int(np.ceil((east - west) * m_lng / cell))
+
+    rows = (north - np.asarray(lat_list, dtype=float)) * m_lat / cell
+    cols = (np.asarray(lng_list, dtype=float) - west) * m_lng / cell
+    counts, _, _ = np.histogram2d(
+        rows, cols, bins=[n_rows, n_cols], range=[[0, n_rows], [0, n_cols]]
+    )
+
+    # Gaussian kernel, zero padded by 4 standard deviations to avoid wrap-around
+    pad = int(np.ceil(4 * bandwidth / cell))
+    offsets = np.arange(-pad, pad + 1) * cell
+    kernel_1d = np.exp(-0.5 * (offsets / bandwidth) ** 2)
+    kernel = np.outer(kernel_1d, kernel_1d)
+    kernel /= kernel.sum()
+
+    shape = (n_rows + 2 * pad, n_cols + 2 * pad)
+    smoothed = np.fft.irfft2(
+        np.fft.rfft2(counts, shape) * np.fft.rfft2(kernel, shape), shape
+    )[pad : pad + n_rows, pad : pad + n_cols]
+
+    density = np.clip(smoothed, 0, None) / (cell / 1000) ** 2
+    return {"density": density, "bounds": bounds, "cell": cell}
+
+
+def density_overlay(grid, name, cmap="YlOrRd", opacity=DENSITY_OPACITY):
+    """Builds a folium ImageOverlay of a density grid, transparent where the density is low (or zero)"""
+    south, west, north, east = grid["bounds"]
+    peak = grid["density"].max()
+    # A layer without points gives a fully transparent image
+    scaled = grid["density"] / peak if peak > 0 else np.zeros_like(grid["density"])
+    rgba = plt.get_cmap(cmap)(scaled)
+    rgba[..., 3] = np.clip(scaled * 4, 0, 1)  # Fading out the low density tail
+
+    return folium.raster_layers.ImageOverlay(
+        image=(rgba * 255).astype(np.uint8),
+        bounds=[[south, west], [north, east]],
+        name=name,
+        opacity=opacity,
+        mercator_project=True,
+    )
+
+
+def grid_cells_by_polygon(grid, geodf):
+    """Assigns the cells of a density grid to the polygons of geodf, by cell center (or the cell of the representative point of polygons smaller than a cell), reusable for every grid with the same bounds and cell size"""
+    south, west, north, east = grid["bounds"]
+    n_rows, n_cols = grid["density"].shape
+    lat = north - (np.arange(n_rows) + 0.5) * (north - south) / n_rows
+    lng = west + (np.arange(n_cols) + 0.5) * (east - west) / n_cols
+    lat_grid, lng_grid = np.meshgrid(lat, lng, indexing="ij")
+
+    centers = shapely.points(lng_grid.ravel(), lat_grid.ravel())
+    center_idx, geom_idx = STRtree(centers).query(
+        geodf["geometry"].values, predicate="contains"
+    )[::-1]
+
+    # Polygons containing no cell center take the cell of their representative point
+    x, y = shapely.bounds(shapely.point_on_surface(geodf["geometry"].values))[:, :2].T
+    row = np.nan_to_num((north - y) / (north - south) * n_rows)
+    col = np.nan_to_num((x - west) / (east - west) * n_cols)
+    row = np.clip(row.astype(int), 0, n_rows - 1)
+    col = np.clip(col.astype(int), 0, n_cols - 1)
+
+    return {
+        "shape": (n_rows, n_cols),
+        "center_idx": center_idx,
+        "geom_idx": geom_idx,
+        "n_samples": np.bincount(geom_idx, minlength=len(geodf)),
+        "fallback_idx": row * n_cols + col,
+    }
+
+
+def density_by_subzone(grid, geodf, cells=None):
+    """Averages a density grid over each polygon of geodf, using the cell assignment of grid_cells_by_polygon (computed if not given)"""
+    if cells is None:
+        cells = grid_cells_by_polygon(grid, geodf)
+    density = grid["density"].ravel()
+    totals = np.bincount(
+        cells["geom_idx"],
+        weights=density[cells["center_idx"]],
+        minlength=len(cells["n_samples"]),
+    )
+    return np.where(
+        cells["n_samples"] > 0,
+        totals / np.maximum(cells["n_samples"], 1),
+        density[cells["fallback_idx"]],
+    )
+
+
+mrt_density = density_grid(mrt_df["lat"], mrt_df["lng"])
+
 # %%
 # Plotting MRT Stations Heatmap
-HeatMap(
-    mrt_df[["lat", "lng"]].values.tolist(), name="MRT Heatmap", radius=12, max_zoom=13
-).add_to(m)
+def mrt_heatmap_layer(grid=mrt_density, coords=mrt_df[["lat", "lng"]].values.tolist()):
+    """MRT Stations density raster, or leaflet.heat layer in heatmap mode"""
+    if HEATMAP_MODE == "raster":
+        return density_overlay(grid, name="MRT Heatmap")
+    return HeatMap(
+        coords,
+        name="MRT Heatmap",
+        radius=12,
+        max_zoom=13,
+    )
+
 
-folium.LayerControl().add_to(m)  # Adding layer controls
+register_layer("mrt_heatmap", mrt_heatmap_layer)
+
+m.add("mrt_heatmap", "layer_control")  # Adding layer controls
 
 m
 
 # %%
 # Foursquare Shopping Malls
-# Creating empty dataframe
-mall_df = pd.DataFrame(
-    columns=[
-        "id",
-        "name",
-        "categories",
-        "referralId",
-        "hasPerk",
-        "location.address",
-        "location.crossStreet",
-        "location.lat",
-        "location.lng",
-        "location.labeledLatLngs",
-        "location.postalCode",
-        "location.cc",
-        "location.city",
-        "location.country",
-        "location.formattedAddress",
-        "location.neighborhood",
-        "location.state",
-        "venuePage.id",
-    ]
-)
-
 # Category IDs for Shopping Mall
 MALL_ID = "4bf58dd8d48988d1fd941735"
 
@@ -593,28 +1624,14 @@ mall_url = "https://api.foursquare.com/v2/venues/search?categoryId={}&client_id=
     MALL_ID, CLIENT_ID, CLIENT_SECRET, AREA, ACCESS_TOKEN, VERSION, LIMIT,
 )
 
-mall_results = requests.get(mall_url).json()
-
-# Assign relevant part of JSON to venues
-mall_venues = mall_results["response"]["venues"]
-
-# Tranform venues into a dataframe
-mall_df = pd.json_normalize(mall_venues)
-
-# Filtering results from other countries
-mall_df = mall_df[mall_df["location.country"].str.contains("Singapore")]
-
-# Filtering results that are not Shopping Mall, Shopping Plaza, Outlet Mall or Supermarket
-mall_df_cat = mall_df.categories.apply(pd.Series).iloc[:, 0].apply(pd.Series)
-mall_df_cat.rename(columns={"id": "cat_df", "name": "cat_name"}, inplace=True)
-mall_df = mall_df.join(mall_df_cat)
-mall_df = mall_df[
-    mall_df["cat_name"].isin(["Shopping Mall", "Shopping Plaza", "Supermarket"])
-]
+if SEARCH_MODE == "tiled":
+    mall_results = tiled_search([{"categoryId": MALL_ID}])
+else:
+    mall_results = fetch_all_json([mall_url])
 
-# Dropping duplicated results based on Foursquare Place ID
-mall_df.drop_duplicates(subset=["id"], inplace=True)
-mall_df.reset_index(inplace=True, drop=True)
+# Keeping only Shopping Malls, Shopping Plazas and Supermarkets in Singapore,
+# deduplicated on Foursquare Place ID
+mall_df = venues_frame(mall_results, ["Shopping Mall", "Shopping Plaza", "Supermarket"])
 
 print(
     "Categories of venues: {}".format(mall_df["cat_name"].unique())
@@ -623,53 +1640,34 @@ mall_df
 
 # %%
 # Plotting Shopping Malls HeatMap against Bubble Tea shop locations
-m1 = folium.Map(location=[1.3521, 103.8198], tiles="cartodbpositron", zoom_start=11)
-
-# Subzone Boundaries
-sub_border.add_to(m1)
-
-# Planning Area Boundaries
-plan_border.add_to(m1)
-
-# Other Bubble Tea Outlets from Foursquare API
-for index, row in boba_df.iterrows():
-    lat = row["location.lat"]
-    lng = row["location.lng"]
-    name = row["name"]
-
-    folium.CircleMarker(
-        location=[lat, lng],
-        radius=3,
-        weight=0,
-        popup=name,
-        color="Blue",
-        fill_color="Blue",
-        fill_opacity=0.5,
-    ).add_to(m1)
-
-# Adding Xing Fu Tang Location
-for lat, lng, add in zip(xft_lat, xft_lng, xft_add):
-    folium.CircleMarker(
-        location=[lat, lng],
-        radius=5,
-        weight=2,
-        popup="Xing Fu Tang @ {}".format(add),
-        color="Black",
-        fill_color="Red",
-        fill_opacity=1,
-    ).add_to(m1)
+mall_density = density_grid(mall_df["location.lat"], mall_df["location.lng"])
+
+
+def mall_heatmap_layer(
+    grid=mall_density, coords=mall_df[["location.lat", "location.lng"]].values.tolist()
+):
+    """Shopping Mall density raster, or leaflet.heat layer in heatmap mode"""
+    if HEATMAP_MODE == "raster":
+        return density_overlay(grid, name="Shopping Mall Heatmap")
+    return HeatMap(
+        coords,
+        name="Shopping Mall Heatmap",
+        radius=12,
+        max_zoom=13,
+    )
 
-m1.get_root().add_child(bubble_macro)  # Adding legend
 
-# Shopping Mall HeatMap
-HeatMap(
-    mall_df[["location.lat", "location.lng"]].values.tolist(),
-    name="Shopping Mall Heatmap",
-    radius=12,
-    max_zoom=13,
-).add_to(m1)
+register_layer("mall_heatmap", mall_heatmap_layer)
 
-folium.LayerControl().add_to(m1)  # Adding layer controls
+m1 = map_views["mall_heatmap"] = MapView(
+    "sub_border",
+    "plan_border",
+    "boba",
+    "xft",
+    "bubble_legend",
+    "mall_heatmap",
+    "layer_control",
+)
 
 m1
 
@@ -685,43 +1683,279 @@ def count_point_in_polygon(polygon, lat_list, lng_list):
 
 
 # %%
-# Counting all features on Subzones
-# Counting number of Other Bubble Tea Stores in Subzone
-for index, row in sub_geodf.iterrows():
-    count_ = count_point_in_polygon(
-        row["geometry"], boba_df["location.lat"], boba_df["location.lng"]
+# Defining Function to count points from several layers in every Subzone in one spatial-join pass
+def count_points_by_polygon(geodf, layers):
+    """Assigns every point of each (lat_list, lng_list) layer to the polygons of geodf with one STRtree query and returns the counts"""
+    tree = STRtree(geodf["geometry"].values)
+    counts = pd.DataFrame(index=geodf.index)
+    for col, (lat_list, lng_list) in layers.items():
+        points = shapely.points(
+            np.asarray(lng_list, dtype=float), np.asarray(lat_list, dtype=float)
+        )
+        # "within" on points is the same test as polygon.contains(point)
+        _, poly_idx = tree.query(points, predicate="within")
+        counts[col] = np.bincount(poly_idx, minlength=len(geodf))
+
+    return counts
+
+
+# %%
+# Precomputed grid index mapping lat/lng to Subzone
+# Cells wholly inside one Subzone resolve directly, only boundary cells need an exact polygon test
+GRID_CELL_SIZE = 0.002  # Cell size in degrees (~220m)
+grid_index_path = os.path.splitext(subzone_geo)[0] + ".gridindex.npz"
+
+
+def build_grid_index(geodf, cell_size=GRID_CELL_SIZE):
+    """Rasterises the polygons of geodf into a grid of owner IDs (-1 outside, -2 boundary) with candidate lists for boundary cells"""
+    geoms = geodf["geometry"].values
+    minx, miny, maxx, maxy = shapely.total_bounds(geoms)
+    ncols = int(np.ceil((maxx - minx) / cell_size))
+    nrows = int(np.ceil((maxy - miny) / cell_size))
+    rows, cols = np.divmod(np.arange(nrows * ncols), ncols)
+    cells = shapely.box(
+        minx + cols * cell_size,
+        miny + rows * cell_size,
+        minx + (cols + 1) * cell_size,
+        miny + (rows + 1) * cell_size,
+    )
+
+    tree = STRtree(geoms)
+    cell_idx, poly_idx = tree.query(cells, predicate="intersects")
+    inside_cell, inside_poly = tree.query(cells, predicate="within")
+
+    owner = np.full(len(cells), -1, dtype=np.int32)
+    owner[np.unique(cell_idx)] = -2
+    owner[inside_cell] = inside_poly
+
+    # Candidate polygons of boundary cells stored as offsets into one flat array
+    boundary = owner[cell_idx] == -2
+    order = np.argsort(cell_idx[boundary], kind="stable")
+    cand_cell = cell_idx[boundary][order]
+    cand_offsets = np.zeros(len(cells) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cand_cell, minlength=len(cells)), out=cand_offsets[1:])
+
+    return {
+        "bounds": np.array([minx, miny, maxx, maxy]),
+        "shape": np.array([nrows, ncols]),
+        "cell_size": np.array(cell_size),
+        "owner": owner,
+        "cand_offsets": cand_offsets,
+        "cand_poly": poly_idx[boundary][order].astype(np.int32),
+    }
+
+
+def load_grid_index(geodf, source_path, index_path, cell_size=GRID_CELL_SIZE):
+    """Loads the grid index saved next to the source file, rebuilding it if the source or cell size changed"""
+    source_hash = file_hash(source_path)
+    if os.path.exists(index_path):
+        with np.load(index_path) as saved:
+            index = dict(saved)
+        if index.pop("source_hash") == source_hash and index["cell_size"] == cell_size:
+            return index
+
+    index = build_grid_index(geodf, cell_size)
+    np.savez_compressed(index_path, source_hash=source_hash, **index)
+
+    return index
+
+
+def lookup_grid_index(index, geodf, lat_list, lng_list):
+    """Returns the geodf row position containing each coordinate (-1 if none)"""
+    lat = np.asarray(lat_list, dtype=float)
+    lng = np.asarray(lng_list, dtype=float)
+    minx, miny = index["bounds"][:2]
+    nrows, ncols = index["shape"]
+    row = np.floor((lat - miny) / index["cell_size"]).astype(np.int64)
+    col = np.floor((lng - minx) / index["cell_size"]).astype(np.int64)
+    valid = (row >= 0) & (row < nrows) & (col >= 0) & (col < ncols)
+    cell = np.where(valid, row * ncols + col, 0)
+    result = np.where(valid, index["owner"][cell], -1)
+
+    # Exact polygon test against the candidates of boundary cells only
+    pending = np.flatnonzero(result == -2)
+    starts = index["cand_offsets"][cell[pending]]
+    lens = index["cand_offsets"][cell[pending] + 1] - starts
+    point_rep = np.repeat(pending, lens)
+    within_group = np.arange(lens.sum()) - np.repeat(np.cumsum(lens) - lens, lens)
+    cand = index["cand_poly"][np.repeat(starts, lens) + within_group]
+    hit = shapely.contains_xy(
+        geodf["geometry"].values[cand], lng[point_rep], lat[point_rep]
     )
+    result[pending] = -1
+    result[point_rep[hit]] = cand[hit]
 
-    # Adding to a column in sub_geodf
-    sub_geodf.loc[index, "other_boba_count"] = count_
+    return result
 
-# Counting number of Xing Fu Tang Stores in Subzone
-for index, row in sub_geodf.iterrows():
-    count_ = count_point_in_polygon(row["geometry"], xft_lat, xft_lng)
 
-    # Adding to a column in sub_geodf
-    sub_geodf.loc[index, "xft_boba_count"] = count_
+def count_points_by_grid_index(index, geodf, layers):
+    """Same output as count_points_by_polygon, resolving points through the grid index"""
+    counts = pd.DataFrame(index=geodf.index)
+    for col, (lat_list, lng_list) in layers.items():
+        poly_idx = lookup_grid_index(index, geodf, lat_list, lng_list)
+        counts[col] = np.bincount(poly_idx[poly_idx >= 0], minlength=len(geodf))
 
-# Counting number of MRT Stations in Subzone
-for index, row in sub_geodf.iterrows():
-    count_ = count_point_in_polygon(row["geometry"], mrt_df["lat"], mrt_df["lng"])
+    return counts
 
-    # Adding to a column in sub_geodf
-    sub_geodf.loc[index, "mrt_count"] = count_
 
-# Counting number of Shopping Malls in Subzone
-for index, row in sub_geodf.iterrows():
-    count_ = count_point_in_polygon(
-        row["geometry"], mall_df["location.lat"], mall_df["location.lng"]
+# %%
+# Compiled point-in-polygon kernel over flattened ring coordinate arrays (optional, needs numba)
+try:
+    from numba import njit, prange
+except ImportError:  # Falls back to plain Python loops (slow) without numba
+    njit = lambda **kwargs: (lambda func: func)
+    prange = range
+
+
+def flatten_polygon_rings(geodf):
+    """Flattens every (Multi)Polygon of geodf into contiguous float64 ring coordinates with ring/geometry offset tables and bounding boxes"""
+    geoms = geodf["geometry"].values
+    parts, part_geom = shapely.get_parts(geoms, return_index=True)
+    rings, ring_part = shapely.get_rings(parts, return_index=True)
+    coords, coord_ring = shapely.get_coordinates(rings, return_index=True)
+
+    ring_offsets = np.zeros(len(rings) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(coord_ring, minlength=len(rings)), out=ring_offsets[1:])
+    geom_ring_offsets = np.zeros(len(geoms) + 1, dtype=np.int64)
+    np.cumsum(
+        np.bincount(part_geom[ring_part], minlength=len(geoms)),
+        out=geom_ring_offsets[1:],
     )
 
-    # Adding to a column in sub_geodf
-    sub_geodf.loc[index, "mall_count"] = count_
+    return {
+        "xs": np.ascontiguousarray(coords[:, 0]),
+        "ys": np.ascontiguousarray(coords[:, 1]),
+        "ring_offsets": ring_offsets,
+        "geom_ring_offsets": geom_ring_offsets,
+        "bboxes": shapely.bounds(geoms),
+    }
+
+
+@njit(parallel=True)
+def _count_points_kernel(px, py, xs, ys, ring_offsets, geom_ring_offsets, bboxes):
+    counts = np.zeros(len(bboxes), dtype=np.int64)
+    for g in prange(len(bboxes)):
+        minx, miny, maxx, maxy = bboxes[g]
+        count = 0
+        for i in range(len(px)):
+            x, y = px[i], py[i]
+            # Bounding box rejection before ray casting
+            if x < minx or x > maxx or y < miny or y > maxy:
+                continue
+            # Even-odd ray casting over every ring (exterior and holes) of the geometry
+            inside = False
+            for r in range(geom_ring_offsets[g], geom_ring_offsets[g + 1]):
+                j = ring_offsets[r + 1] - 1
+                for k in range(ring_offsets[r], ring_offsets[r + 1]):
+                    if (ys[k] > y) != (ys[j] > y):
+                        dx = (xs[j] - xs[k]) * (y - ys[k]) / (ys[j] - ys[k])
+                        if x < xs[k] + dx:
+                            inside = not inside
+                    j = k
+            if inside:
+                count += 1
+        counts[g] = count
+
+    return counts
+
+
+def count_points_by_kernel(rings, geodf, layers):
+    """Same output as count_points_by_polygon, using the compiled ray casting kernel"""
+    counts = pd.DataFrame(index=geodf.index)
+    for col, (lat_list, lng_list) in layers.items():
+        counts[col] = _count_points_kernel(
+            np.asarray(lng_list, dtype=np.float64),
+            np.asarray(lat_list, dtype=np.float64),
+            rings["xs"],
+            rings["ys"],
+            rings["ring_offsets"],
+            rings["geom_ring_offsets"],
+            rings["bboxes"],
+        )
+
+    return counts
+
+
+# %%
+# Counting all features on Subzones
+# Other Bubble Tea Stores, Xing Fu Tang Stores, MRT Stations and Shopping Malls in Subzone
+# The grid index and flattened rings are only built for the engine that uses them
+COUNT_ENGINE = "strtree"  # "strtree", "grid" or "numba"
+
+count_layers = {
+    "other_boba_count": (boba_df["location.lat"], boba_df["location.lng"]),
+    "xft_boba_count": (xft_lat, xft_lng),
+    "mrt_count": (mrt_df["lat"], mrt_df["lng"]),
+    "mall_count": (mall_df["location.lat"], mall_df["location.lng"]),
+}
+
+if COUNT_ENGINE == "grid":
+    sub_grid_index = load_grid_index(sub_geodf, subzone_geo, grid_index_path)
+    count_df = count_points_by_grid_index(sub_grid_index, sub_geodf, count_layers)
+elif COUNT_ENGINE == "numba":
+    sub_rings = flatten_polygon_rings(sub_geodf)
+    count_df = count_points_by_kernel(sub_rings, sub_geodf, count_layers)
+else:
+    count_df = count_points_by_polygon(sub_geodf, count_layers)
+
+# Adding to columns in sub_geodf
+sub_geodf[list(count_df.columns)] = count_df
+
+# Smoothed MRT Station and Shopping Mall densities (per km2) in Subzone, kept out of
+# sub_geodf so they only become clustering features when merged in explicitly
+if SUBZONE_DENSITY:
+    sub_grid_cells = grid_cells_by_polygon(mrt_density, sub_geodf)  # Same grid for both
+    sub_density_df = pd.DataFrame(
+        {
+            "Subzone": sub_geodf["Subzone"],
+            "mrt_density": density_by_subzone(mrt_density, sub_geodf, sub_grid_cells),
+            "mall_density": density_by_subzone(
+                mall_density, sub_geodf, sub_grid_cells
+            ),
+        }
+    )
+
+# %%
+# Benchmark of Subzone counting engines against count_point_in_polygon
+RUN_COUNT_BENCHMARK = False
+
+if RUN_COUNT_BENCHMARK:
+    sub_grid_index = load_grid_index(sub_geodf, subzone_geo, grid_index_path)
+    sub_rings = flatten_polygon_rings(sub_geodf)
+    bench_timings = []
+
+    start = time.perf_counter()
+    ref_df = pd.DataFrame(index=sub_geodf.index)
+    for col, (lat_list, lng_list) in count_layers.items():
+        ref_df[col] = [
+            count_point_in_polygon(polygon, lat_list, lng_list)
+            for polygon in sub_geodf["geometry"]
+        ]
+    bench_timings.append(("count_point_in_polygon", time.perf_counter() - start, True))
+
+    bench_engines = {
+        "strtree": lambda: count_points_by_polygon(sub_geodf, count_layers),
+        "grid": lambda: count_points_by_grid_index(
+            sub_grid_index, sub_geodf, count_layers
+        ),
+        "numba": lambda: count_points_by_kernel(sub_rings, sub_geodf, count_layers),
+    }
+    for engine, run in bench_engines.items():
+        run()  # Warm up (numba compilation)
+        start = time.perf_counter()
+        engine_df = run()
+        bench_timings.append(
+            (engine, time.perf_counter() - start, engine_df.equals(ref_df))
+        )
+
+    print(pd.DataFrame(bench_timings, columns=["Engine", "Seconds", "Same counts"]))
 
 # %%
-# Reading Population/Age and Dwelling Type Data File (Previously trimmed to only include 2020 data)
-pt_df = pd.read_csv("respopagesextod2020.csv")
-pt_df.columns = [
+# Reading Population/Age and Dwelling Type Data File
+# The raw multi-year SingStat file is streamed in chunks, keeping only CENSUS_YEARS
+CENSUS_CSV = "respopagesextod2020.csv"  # Also accepts the raw multi-year file
+CENSUS_YEARS = [2020]  # None keeps every year
+CENSUS_COLUMNS = [
     "Planning Area",
     "Subzone",
     "Age Group",
@@ -730,32 +1964,111 @@ pt_df.columns = [
     "Population",
     "Time",
 ]
+CENSUS_CATEGORIES = ["Planning Area", "Subzone", "Age Group", "Sex", "Type of Dwelling"]
 
-# Converting columns to uppercase
-pt_df["Planning Area"] = pt_df["Planning Area"].str.upper()
-pt_df["Subzone"] = pt_df["Subzone"].str.upper()
+
+def upper_categorical(series):
+    """Uppercases the categories of a categorical Series, merging categories that only differ by case"""
+    upper = series.cat.categories.str.upper()
+    uniques = upper.unique()
+    new_codes = uniques.get_indexer(upper)[series.cat.codes]
+    new_codes[series.cat.codes.to_numpy() == -1] = -1  # Keep missing values
+
+    return pd.Series(
+        pd.Categorical.from_codes(new_codes, uniques),
+        index=series.index,
+        name=series.name,
+    )
+
+
+def load_census(path, years=CENSUS_YEARS, columns=CENSUS_COLUMNS, chunksize=500_000):
+    """Streams a SingStat population CSV in chunks, keeping only the rows of years and the requested columns, with categorical string columns"""
+    # Columns are renamed by position, the raw file uses short names (PA, SZ, AG, ...)
+    names = dict(zip(pd.read_csv(path, nrows=0).columns, CENSUS_COLUMNS))
+    usecols = [col for col, name in names.items() if name in columns or name == "Time"]
+    dtype = {
+        col: "category" for col, name in names.items() if name in CENSUS_CATEGORIES
+    }
+
+    chunks = []
+    for chunk in pd.read_csv(path, usecols=usecols, dtype=dtype, chunksize=chunksize):
+        chunk = chunk.rename(columns=names)
+        if years is not None:
+            chunk = chunk[chunk["Time"].isin(years)]
+        chunks.append(chunk)
+
+    # Aligning categories across chunks so they stay categorical when concatenated
+    cat_cols = [col for col in CENSUS_CATEGORIES if col in chunks[0]]
+    dtypes = {
+        col: pd.CategoricalDtype(
+            union_categoricals([chunk[col] for chunk in chunks]).categories
+        )
+        for col in cat_cols
+    }
+    census_df = pd.concat([chunk.astype(dtypes) for chunk in chunks], ignore_index=True)
+
+    # Converting columns to uppercase (on the categories only)
+    for col in ["Planning Area", "Subzone"]:
+        if col in census_df:
+            census_df[col] = upper_categorical(census_df[col])
+
+    return census_df[columns]
+
+
+pt_df = load_census(CENSUS_CSV)
 
 # %%
-# # Calculating Population by Age Group by Subzone
-# # NOTE Potential for performance improvements
-# age_ranges = list(pt_df["Age Group"].unique())
-# age_df = pd.DataFrame(sz_list, columns=["Subzone"])
-# pt_trim_df = pt_df[["Subzone", "Age Group", "Population"]]
-
-# for age in age_ranges:
-#     age_list = []
-#     for subzone in sz_list:
-#         age_sum = pt_trim_df.loc[(pt_trim_df["Subzone"] == subzone) & (pt_trim_df["Age Group"] == age)]["Population"].sum()
-#         age_list.append((subzone, age_sum))
-#     age_df = age_df.merge(
-#         pd.DataFrame(age_list, columns=["Subzone", age]), how="left", on="Subzone"
-#     )
-
-# # Getting total population of target age group
-# age_df["pop_total20_44"] = age_df[['20_to_24','25_to_29', '30_to_34', '35_to_39', '40_to_44']].sum(axis=1)
-# age_df.to_csv("ages_pop2020.csv", index=False)
-
-age_df = pd.read_csv("ages_pop2020.csv")
+# Calculating Population by Age Group by Subzone
+# Subzone x age band table with cumulative sums, so the population of any age window is one slice
+TARGET_AGE_MIN = 20
+TARGET_AGE_MAX = 44
+
+
+def age_band_start(label):
+    """Returns the first age of an age group label (e.g. 20 for 20_to_24, 90 for 90_and_over)"""
+    return int(re.match(r"\d+", label).group())
+
+
+def build_age_cube(pt_df, level="Subzone"):
+    """Pivots pt_df into a level x age band population array and its cumulative sums along the age axis"""
+    age_pop = (
+        pt_df.groupby([level, "Age Group"], observed=True)["Population"]
+        .sum()
+        .unstack(fill_value=0)
+    )
+    age_pop = age_pop[sorted(age_pop.columns, key=age_band_start)]
+
+    cum = np.zeros((len(age_pop), len(age_pop.columns) + 1), dtype=np.int64)
+    np.cumsum(age_pop.to_numpy(), axis=1, out=cum[:, 1:])
+
+    return {
+        "index": age_pop.index.astype(str),
+        "bands": list(age_pop.columns.astype(str)),
+        "starts": np.array([age_band_start(band) for band in age_pop.columns]),
+        "cum": cum,
+    }
+
+
+def age_window_population(cube, age_min, age_max):
+    """Returns the population of the age bands starting between age_min and age_max for every row of the cube"""
+    lo = np.searchsorted(cube["starts"], age_min, side="left")
+    hi = np.searchsorted(cube["starts"], age_max, side="right")
+
+    return pd.Series(cube["cum"][:, hi] - cube["cum"][:, lo], index=cube["index"])
+
+
+age_cube = build_age_cube(pt_df)
+
+# Population per age band, recovered from the cumulative sums
+age_df = pd.DataFrame(
+    np.diff(age_cube["cum"], axis=1), index=age_cube["index"], columns=age_cube["bands"]
+)
+
+# Getting total population of target age group
+age_df["pop_total20_44"] = age_window_population(
+    age_cube, TARGET_AGE_MIN, TARGET_AGE_MAX
+)
+age_df = age_df.rename_axis("Subzone").reset_index()
 
 # %%
 # Setting Type of Dwelling into Dwelling Index
@@ -765,29 +2078,37 @@ tod_val = [2, 3, 4, 5, 6, 8, 7, 1]  # Giving weights to TOD
 tod_dict = {tod_key[i]: tod_val[i] for i in range(len(tod_key))}
 tod_dict
 
-pt_df["Dwelling Weight"] = pt_df["Type of Dwelling"].map(tod_dict)
+pt_df["Dwelling Weight"] = pt_df["Type of Dwelling"].map(tod_dict).astype("int64")
 pt_df["Dwelling Index"] = pt_df["Dwelling Weight"] * pt_df["Population"]
 pt_df.head()
 
 sz_list = list(pt_df["Subzone"].unique())  # List of subzones
 
-# Setting Sum of Population and Dwelling Index into a DataFrame
-dwell_list = []
-pop_list = []
 
-for subzone in sz_list:
-    index_sum = pt_df.loc[pt_df["Subzone"] == subzone]["Dwelling Index"].sum()
-    pop_sum = pt_df.loc[pt_df["Subzone"] == subzone]["Population"].sum()
-    count_ = index_sum / pop_sum
-    dwell_list.append((subzone, count_))
-    pop_list.append((subzone, pop_sum))
+# Defining Function to sum Population and Dwelling Index by Subzone/Planning Area
+def aggregate_population(pt_df, level="Subzone", extra=None):
+    """Aggregates pt_df by level in one grouped pass and returns Population, population-weighted Dwelling Index and any extra named aggregations"""
+    agg_df = pt_df.groupby(level, sort=False, observed=True).agg(
+        index_sum=("Dwelling Index", "sum"),
+        Population=("Population", "sum"),
+        **(extra or {}),
+    )
+    dwell_idx = agg_df.pop("index_sum") / agg_df["Population"]
+    agg_df.insert(0, "Dwelling Index", dwell_idx)
 
-dwell_df = pd.DataFrame(dwell_list, columns=["Subzone", "Dwelling Index"])
-pop_df = pd.DataFrame(pop_list, columns=["Subzone", "Population"])
+    return agg_df.reset_index()
+
+
+# Setting Sum of Population and Dwelling Index into a DataFrame
+pop_df = aggregate_population(pt_df)
 
 # Merging Dwelling Index into Subzone GeoDataFrame
-sub_geodf = pd.merge(sub_geodf, dwell_df, how="left", on="Subzone")
-sub_geodf = pd.merge(sub_geodf, pop_df, how="left", on="Subzone")
+sub_geodf = pd.merge(
+    sub_geodf,
+    pop_df[["Subzone", "Dwelling Index", "Population"]],
+    how="left",
+    on="Subzone",
+)
 
 # Renaming columns for consistency
 sub_geodf.rename(
@@ -801,150 +2122,177 @@ main_geodf = sub_geodf.merge(
 )
 
 # %%
-# Plotting Population (25yo - 45yo) Data
-m2 = folium.Map(location=[1.3521, 103.8198], tiles="cartodbpositron", zoom_start=11)
-
-# Population Choropleth
-folium.Choropleth(
-    main_geodf,
-    name="Population",
-    legend_name="Population, 2020",
-    data=main_geodf,
-    columns=["Subzone", "pop_total20_44"],
-    key_on="feature.properties.Subzone",
-    fill_color="Blues",
-    fill_opacity=0.7,
-    line_opacity=0.2,
-).add_to(m2)
+# Memory-mapped multi-year demographic cube (year x subzone x age x sex x dwelling)
+# Time series queries become array slices instead of re-parsing the census CSV
+CENSUS_CUBE_PATH = "census_cube.npy"  # Axis labels are saved in census_cube.json
+BUILD_CENSUS_CUBE = False  # Rebuild from every year of CENSUS_CSV
+CUBE_AXES = ["Time", "Subzone", "Age Group", "Sex", "Type of Dwelling"]
+
+
+def build_census_cube(census_df, path=CENSUS_CUBE_PATH):
+    """Integer-codes census_df into a dense int32 population cube saved as a memory-mappable .npy file, with the axis labels in a JSON sidecar"""
+    labels = {}
+    codes = []
+    for axis in CUBE_AXES:
+        values = pd.Series(census_df[axis].unique()).tolist()
+        key = age_band_start if axis == "Age Group" else None
+        labels[axis] = sorted(values, key=key)
+        codes.append(pd.Categorical(census_df[axis], categories=labels[axis]).codes)
+
+    shape = tuple(len(labels[axis]) for axis in CUBE_AXES)
+    flat_pop = np.bincount(
+        np.ravel_multi_index(codes, shape),
+        weights=census_df["Population"],
+        minlength=int(np.prod(shape)),
+    )
+    cube = np.lib.format.open_memmap(path, mode="w+", dtype=np.int32, shape=shape)
+    cube[...] = flat_pop.reshape(shape)
+    cube.flush()
+    del cube
 
-# Subzone Boundaries
-folium.GeoJson(
-    main_geodf,
-    name="Subzone Borders",
-    style_function=sub_style_function,
-    highlight_function=highlight_function,
-    tooltip=folium.GeoJsonTooltip(
-        fields=["Subzone", "Planning Area", "pop_total20_44"],
-        aliases=["Subzone: ", "Planning Area: ", "Population (25yo - 45yo): "],
-        style=(
-            "background-color: white; color: #333333; font-family: arial; font-size: 12px; padding: 10px;"
-        ),
-    ),
-).add_to(m2)
+    with open(os.path.splitext(path)[0] + ".json", "w") as f:
+        json.dump(labels, f)
 
-# Planning Area Boundaries
-plan_border.add_to(m2)
+    return load_census_cube(path)
 
-# Other Bubble Tea Outlets from Foursquare API
-for index, row in boba_df.iterrows():
-    lat = row["location.lat"]
-    lng = row["location.lng"]
-    name = row["name"]
 
-    folium.CircleMarker(
-        location=[lat, lng],
-        radius=3,
-        weight=0,
-        popup=name,
-        color="Blue",
-        fill_color="Blue",
-        fill_opacity=0.5,
-    ).add_to(m2)
+def load_census_cube(path=CENSUS_CUBE_PATH):
+    """Memory-maps a saved census cube and returns it with its axis labels and label positions"""
+    with open(os.path.splitext(path)[0] + ".json") as f:
+        labels = json.load(f)
 
-# Adding Xing Fu Tang Location
-for lat, lng, add in zip(xft_lat, xft_lng, xft_add):
-    folium.CircleMarker(
-        location=[lat, lng],
-        radius=5,
-        weight=2,
-        popup="Xing Fu Tang @ {}".format(add),
-        color="Black",
-        fill_color="Red",
-        fill_opacity=1,
-    ).add_to(m2)
+    return {
+        "data": np.load(path, mmap_mode="r"),
+        "labels": labels,
+        "position": {
+            axis: {label: i for i, label in enumerate(values)}
+            for axis, values in labels.items()
+        },
+    }
 
-m2.get_root().add_child(bubble_macro)  # Adding legend
 
-m2
-# %%
-# Plotting Dwelling Type
-m3 = folium.Map(location=[1.3521, 103.8198], tiles="cartodbpositron", zoom_start=11)
-
-# Dwelling Type Choropleth
-folium.Choropleth(
-    main_geodf,
-    name="Average Dwelling Types",
-    legend_name="Dwelling Index",
-    data=main_geodf,
-    columns=["Subzone", "dwell_idx"],
-    key_on="feature.properties.Subzone",
-    fill_color="Greens",
-    fill_opacity=0.7,
-    line_opacity=0.2,
-).add_to(m3)
+def cube_population_trend(cube):
+    """Returns the population of every subzone (columns) for every year (rows)"""
+    return pd.DataFrame(
+        np.asarray(cube["data"]).sum(axis=(2, 3, 4)),
+        index=cube["labels"]["Time"],
+        columns=cube["labels"]["Subzone"],
+    )
 
-# Subzone Boundaries
-folium.GeoJson(
-    main_geodf,
-    name="Subzone Borders",
-    style_function=sub_style_function,
-    highlight_function=highlight_function,
-    tooltip=folium.GeoJsonTooltip(
-        fields=["Subzone", "Planning Area", "dwell_idx"],
-        aliases=["Subzone: ", "Planning Area: ", "Dwelling Index: "],
-        style=(
-            "background-color: white; color: #333333; font-family: arial; font-size: 12px; padding: 10px;"
-        ),
-    ),
-).add_to(m3)
 
-# Planning Area Boundaries
-plan_border.add_to(m3)
+def cube_dwelling_mix(cube, year):
+    """Returns the population of every subzone (rows) by Type of Dwelling (columns) for a year"""
+    year_data = cube["data"][cube["position"]["Time"][year]]
+    return pd.DataFrame(
+        np.asarray(year_data).sum(axis=(1, 2)),
+        index=cube["labels"]["Subzone"],
+        columns=cube["labels"]["Type of Dwelling"],
+    )
 
-# Other Bubble Tea Outlets from Foursquare API
-for index, row in boba_df.iterrows():
-    lat = row["location.lat"]
-    lng = row["location.lng"]
-    name = row["name"]
 
-    folium.CircleMarker(
-        location=[lat, lng],
-        radius=3,
-        weight=0,
-        popup=name,
-        color="Blue",
-        fill_color="Blue",
-        fill_opacity=0.5,
-    ).add_to(m3)
+def cube_dwelling_index(cube, year, weights):
+    """Returns the population-weighted Dwelling Index of every subzone for a year"""
+    mix = cube_dwelling_mix(cube, year)
+    return mix.to_numpy() @ mix.columns.map(weights).to_numpy() / mix.sum(axis=1)
+
+
+def cube_age_cube(cube, year):
+    """Returns the age cube of a year, for use with age_window_population"""
+    year_data = cube["data"][cube["position"]["Time"][year]]
+    age_pop = np.asarray(year_data).sum(axis=(2, 3))
+    cum = np.zeros((age_pop.shape[0], age_pop.shape[1] + 1), dtype=np.int64)
+    np.cumsum(age_pop, axis=1, out=cum[:, 1:])
+    bands = cube["labels"]["Age Group"]
+
+    return {
+        "index": pd.Index(cube["labels"]["Subzone"]),
+        "bands": bands,
+        "starts": np.array([age_band_start(band) for band in bands]),
+        "cum": cum,
+    }
 
-# Adding Xing Fu Tang Location
-for lat, lng, add in zip(xft_lat, xft_lng, xft_add):
-    folium.CircleMarker(
-        location=[lat, lng],
-        radius=5,
-        weight=2,
-        popup="Xing Fu Tang @ {}".format(add),
-        color="Black",
-        fill_color="Red",
-        fill_opacity=1,
-    ).add_to(m3)
 
-m3.get_root().add_child(bubble_macro)  # Adding legend
+if BUILD_CENSUS_CUBE:
+    census_cube = build_census_cube(load_census(CENSUS_CSV, years=None))
+elif os.path.exists(CENSUS_CUBE_PATH):
+    census_cube = load_census_cube()
+
+# %%
+# Plotting Population (25yo - 45yo) Data
+# Population Choropleth (with Subzone tooltips)
+register_layer(
+    "population",
+    lambda geodf=main_geodf.copy(): choropleth_layer(
+        geodf,
+        name="Population",
+        legend_name="Population, 2020",
+        data=geodf,
+        columns=["Subzone", "pop_total20_44"],
+        key_on="feature.properties.Subzone",
+        fill_color="Blues",
+        fill_opacity=0.7,
+        line_opacity=0.2,
+        highlight_function=highlight_function,
+        tooltip=folium.GeoJsonTooltip(
+            fields=["Subzone", "Planning Area", "pop_total20_44"],
+            aliases=["Subzone: ", "Planning Area: ", "Population (25yo - 45yo): "],
+            style=(
+                "background-color: white; color: #333333; font-family: arial; font-size: 12px; padding: 10px;"
+            ),
+        ),
+    ),
+)
+
+m2 = map_views["population"] = MapView(
+    "population",
+    "plan_border",
+    "boba",
+    "xft",
+    "bubble_legend",
+)
+
+m2
+# %%
+# Plotting Dwelling Type
+# Dwelling Type Choropleth (with Subzone tooltips)
+register_layer(
+    "dwelling",
+    lambda geodf=main_geodf.copy(): choropleth_layer(
+        geodf,
+        name="Average Dwelling Types",
+        legend_name="Dwelling Index",
+        data=geodf,
+        columns=["Subzone", "dwell_idx"],
+        key_on="feature.properties.Subzone",
+        fill_color="Greens",
+        fill_opacity=0.7,
+        line_opacity=0.2,
+        highlight_function=highlight_function,
+        tooltip=folium.GeoJsonTooltip(
+            fields=["Subzone", "Planning Area", "dwell_idx"],
+            aliases=["Subzone: ", "Planning Area: ", "Dwelling Index: "],
+            style=(
+                "background-color: white; color: #333333; font-family: arial; font-size: 12px; padding: 10px;"
+            ),
+        ),
+    ),
+)
+
+m3 = map_views["dwelling"] = MapView(
+    "dwelling",
+    "plan_border",
+    "boba",
+    "xft",
+    "bubble_legend",
+)
 
 m3
 
 # %%
 # Income Data Preparation
 fincdf = pd.read_csv("SG_planningarea_inc.csv")
-incdf_cs = pd.read_csv("SG_planningarea_inc.csv")
-incdf_cs.loc[:, fincdf.columns != "Planning Area"] = incdf_cs.loc[
-    :, fincdf.columns != "Planning Area"
-].cumsum(axis=1)
-
-# Cumulative Planning Area Median Pop
-incdf_cs["cum_med_pop"] = fincdf.sum(axis=1, numeric_only=True) / 2
 
-# Identifying median income bracket by Planning Area
+# Income brackets and their edges (SGD)
 inc_brackets = [
     "Below $1,000",
     "$1,000 - $1,499",
@@ -962,105 +2310,161 @@ inc_brackets = [
     "$11,000 - $11,999",
     "$12,000 & Over",
 ]
-
-med_inc_bracket = []
-for index, row in incdf_cs.iterrows():
-    med_inc_bracket.append(row[inc_brackets].gt(row["cum_med_pop"]).idxmax())
-
-incdf_cs["med_inc_bracket"] = med_inc_bracket
-
-brack_mid = {
-    "Below $1,000": 500,
-    "$1,000 - $1,499": 1250,
-    "$1,500 - $1,999": 1750,
-    "$2,000 - $2,499": 2250,
-    "$2,500 - $2,999": 2750,
-    "$3,000 - $3,999": 3500,
-    "$4,000 - $4,999": 4500,
-    "$5,000 - $5,999": 5500,
-    "$6,000 - $6,999": 6500,
-    "$7,000 - $7,999": 7500,
-    "$8,000 - $8,999": 8500,
-    "$9,000 - $9,999": 9500,
-    "$10,000 - $10,999": 10500,
-    "$11,000 - $11,999": 11500,
-    "$12,000 & Over": 12500,
-}
-
-incdf_cs["median_inc"] = incdf_cs["med_inc_bracket"].map(brack_mid)
+inc_edges = np.array(
+    [0, 1000, 1500, 2000, 2500, 3000, 4000, 5000, 6000, 7000, 8000, 9000, 10000]
+    + [11000, 12000, 13000]  # Open top bracket closed at 13,000 (midpoint 12,500)
+)
+INC_INTERPOLATE = False  # True: interpolate within the bracket, False: bracket midpoint
+
+
+# Defining Functions for quantiles of binned (histogram) tables
+def quantile_bins(counts, q):
+    """Returns the bin holding the q quantile of every row of a (rows x bins) count matrix, and the cumulative counts"""
+    cum = np.cumsum(np.asarray(counts, dtype=float), axis=1)
+    n_rows, n_bins = cum.shape
+    targets = cum[:, -1] * q
+
+    # One searchsorted over all rows, offsetting each row above the previous one
+    offsets = np.arange(n_rows) * (cum[:, -1].max() + 1)
+    flat_cum = (cum + offsets[:, None]).ravel()
+    flat_bins = np.searchsorted(flat_cum, targets + offsets, side="right")
+    # q = 1 runs past the last bin, clamp to the last non-empty one (rows of zeros: any)
+    last_bins = n_bins - 1 - np.argmax(np.asarray(counts)[:, ::-1] > 0, axis=1)
+    bins = np.minimum(flat_bins - np.arange(n_rows) * n_bins, last_bins)
+
+    return bins, cum
+
+
+def binned_quantiles(counts, edges, quantiles, interpolate=False):
+    """Returns the quantiles of every row of a (rows x bins) count matrix with bin edges, as a (rows x quantiles) array (NaN for rows without counts)"""
+    counts = np.asarray(counts, dtype=float)
+    rows = np.arange(len(counts))
+    empty = counts.sum(axis=1) == 0
+    values = []
+    for q in quantiles:
+        bins, cum = quantile_bins(counts, q)
+        lower, upper = edges[bins], edges[bins + 1]
+        if interpolate:
+            below = cum[rows, bins] - counts[rows, bins]
+            in_bin = np.where(empty, 1, counts[rows, bins])  # Empty rows are NaN below
+            share = (cum[:, -1] * q - below) / in_bin
+            value = lower + share * (upper - lower)
+        else:
+            value = (lower + upper) / 2
+        values.append(np.where(empty, np.nan, value))
+
+    return np.column_stack(values)
+
+
+# Defining Functions for areal/dasymetric interpolation between polygon layers
+INC_DOWNSCALE = False  # True: redistribute Planning Area income brackets to Subzones
+AREA_CRS = "EPSG:3414"  # SVY21, metres
+overlay_cache = {}  # Intersection areas, keyed on the geometries of both layers
+
+
+def overlay_areas(source_geodf, target_geodf, crs=AREA_CRS):
+    """Returns the source and target positions and intersection area of every overlapping polygon pair, plus the target areas"""
+    key = hashlib.sha256(
+        b"".join(shapely.to_wkb(source_geodf["geometry"].values))
+        + b"|"
+        + b"".join(shapely.to_wkb(target_geodf["geometry"].values))
+        + crs.encode()
+    ).hexdigest()
+    if key not in overlay_cache:
+        source = source_geodf["geometry"].to_crs(crs).values
+        target = target_geodf["geometry"].to_crs(crs).values
+        target_idx, source_idx = STRtree(source).query(target, predicate="intersects")
+        pieces = shapely.intersection(source[source_idx], target[target_idx])
+        areas = shapely.area(pieces)
+        overlay_cache[key] = (source_idx, target_idx, areas, shapely.area(target))
+
+    return overlay_cache[key]
+
+
+def dasymetric_counts(source_geodf, source_counts, target_geodf, target_weights):
+    """Redistributes the (sources x bins) counts of source polygons to target polygons in proportion to target weight x share of the target area overlapping each source"""
+    overlay = overlay_areas(source_geodf, target_geodf)
+    source_idx, target_idx, areas, target_areas = overlay
+    area_share = areas / target_areas[target_idx]
+
+    # Dense (targets x sources) weight matrix, normalised so every source count is kept
+    weights = np.zeros((len(target_geodf), len(source_geodf)))
+    np.add.at(
+        weights,
+        (target_idx, source_idx),
+        np.asarray(target_weights, dtype=float)[target_idx] * area_share,
+    )
+    area_weights = np.zeros_like(weights)
+    np.add.at(area_weights, (target_idx, source_idx), area_share)
+    # Sources without weighted overlap (e.g. no population) fall back to area shares
+    empty = weights.sum(axis=0) == 0
+    weights[:, empty] = area_weights[:, empty]
+    totals = weights.sum(axis=0)
+    weights = np.divide(weights, totals, out=np.zeros_like(weights), where=totals > 0)
+
+    return weights @ np.asarray(source_counts, dtype=float)
+
+
+# Identifying median income bracket and quartiles by Planning Area
+inc_counts = fincdf[inc_brackets].to_numpy()
+incdf_cs = fincdf[["Planning Area"]].copy()
+incdf_cs["med_inc_bracket"] = np.array(inc_brackets)[quantile_bins(inc_counts, 0.5)[0]]
+incdf_cs[["inc_p25", "median_inc", "inc_p75"]] = binned_quantiles(
+    inc_counts, inc_edges, [0.25, 0.5, 0.75], INC_INTERPOLATE
+)
 
 incdf = incdf_cs[["Planning Area", "median_inc"]]
 geoinc = plan_geodf.merge(incdf, on="Planning Area", how="left")
 
 # Set median income into main_geodf
-main_geodf = main_geodf.merge(incdf, on="Planning Area", how="left")
+if INC_DOWNSCALE:
+    # Subzone level income from the dasymetric interpolation of the bracket counts
+    inc_plan_geodf = plan_geodf.merge(fincdf, on="Planning Area", how="inner")
+    sub_inc_counts = dasymetric_counts(
+        inc_plan_geodf,
+        inc_plan_geodf[inc_brackets].to_numpy(),
+        main_geodf,
+        main_geodf["pop_total"].fillna(0).to_numpy(),
+    )
+    main_geodf["median_inc"] = binned_quantiles(
+        sub_inc_counts, inc_edges, [0.5], INC_INTERPOLATE
+    )[:, 0]
+    main_geodf.loc[sub_inc_counts.sum(axis=1) == 0, "median_inc"] = np.nan
+else:
+    main_geodf = main_geodf.merge(incdf, on="Planning Area", how="left")
 
 # %%
 # Plotting Income Levels
-m4 = folium.Map(location=[1.3521, 103.8198], tiles="cartodbpositron", zoom_start=11)
-
-# Income Levels Choropleth
-folium.Choropleth(
-    geoinc,
-    name="Median Income by Planning Area",
-    legend_name="Median Income (SGD)",
-    data=geoinc,
-    columns=["Planning Area", "median_inc"],
-    key_on="feature.properties.Planning Area",
-    fill_color="Purples",
-    fill_opacity=0.7,
-    line_opacity=0.2,
-).add_to(m4)
-
-# Planning Area Boundaries
-folium.GeoJson(
-    geoinc,
-    name="Planning Area Borders",
-    style_function=lambda x: {
-        "fillColor": "#00000000",
-        "color": "Black",
-        "fill": True,
-        "weight": 1,
-    },
-    highlight_function=highlight_function,
-    tooltip=folium.GeoJsonTooltip(
-        fields=["Planning Area", "median_inc"],
-        aliases=["Planning Area: ", "Median Income (SGD): "],
-        style=(
-            "background-color: white; color: #333333; font-family: arial; font-size: 12px; padding: 10px;"
+# Income Levels Choropleth (with Planning Area tooltips)
+register_layer(
+    "income",
+    lambda geodf=geoinc.copy(): choropleth_layer(
+        geodf,
+        name="Median Income by Planning Area",
+        legend_name="Median Income (SGD)",
+        data=geodf,
+        columns=["Planning Area", "median_inc"],
+        key_on="feature.properties.Planning Area",
+        fill_color="Purples",
+        fill_opacity=0.7,
+        line_opacity=0.2,
+        highlight_function=highlight_function,
+        tooltip=folium.GeoJsonTooltip(
+            fields=["Planning Area", "median_inc"],
+            aliases=["Planning Area: ", "Median Income (SGD): "],
+            style=(
+                "background-color: white; color: #333333; font-family: arial; font-size: 12px; padding: 10px;"
+            ),
         ),
     ),
-).add_to(m4)
-
-# Other Bubble Tea Outlets from Foursquare API
-for index, row in boba_df.iterrows():
-    lat = row["location.lat"]
-    lng = row["location.lng"]
-    name = row["name"]
-
-    folium.CircleMarker(
-        location=[lat, lng],
-        radius=3,
-        weight=0,
-        popup=name,
-        color="Blue",
-        fill_color="Blue",
-        fill_opacity=0.5,
-    ).add_to(m4)
-
-# Adding Xing Fu Tang Location
-for lat, lng, add in zip(xft_lat, xft_lng, xft_add):
-    folium.CircleMarker(
-        location=[lat, lng],
-        radius=5,
-        weight=2,
-        popup="Xing Fu Tang @ {}".format(add),
-        color="Black",
-        fill_color="Red",
-        fill_opacity=1,
-    ).add_to(m4)
+)
 
-m4.get_root().add_child(bubble_macro)  # Adding legend
+m4 = map_views["income"] = MapView(
+    "income",
+    "boba",
+    "xft",
+    "bubble_legend",
+)
 
 m4
 
@@ -1179,124 +2583,97 @@ else:
 
 color_step = cmp.StepColormap(color_list, vmin=1, vmax=k_opt, caption="Clusters",)
 
-cluster_dict = cluster_geodf.set_index("Subzone")["cluster"]
+# Cluster colours for every Subzone, looked up once per cluster
+cluster_colors = cluster_geodf["cluster"].map(
+    {cluster: color_step(cluster) for cluster in cluster_geodf["cluster"].unique()}
+)
 
 # %%
 # Plot Subzones clusters on Map
-m5 = folium.Map(location=[1.3521, 103.8198], tiles="cartodbpositron", zoom_start=11)
-
 # Colouring Subzones based on Clusters
-cluster_gj = folium.GeoJson(
-    cluster_geodf,
-    style_function=lambda feature: {
-        "fillColor": color_step(cluster_dict[feature["properties"]["Subzone"]]),
-        "color": color_step(cluster_dict[feature["properties"]["Subzone"]]),
-        "fillOpacity": 0.5,
-        "weight": 1,
-    },
-    tooltip=folium.GeoJsonTooltip(
-        fields=["Planning Area", "Subzone", "cluster"],
-        aliases=["Planning Area: ", "Subzone: ", "Cluster: "],
-        style=(
-            "background-color: white; color: #333333; font-family: arial; font-size: 12px; padding: 10px;"
+register_layer(
+    "clusters",
+    lambda geodf=cluster_geodf.copy(), colors=cluster_colors.copy(): boundary_layer(
+        style_properties(
+            geodf,
+            fillColor=colors,
+            color=colors,
+            fillOpacity=0.5,
+            weight=1,
+        ),
+        style=PROPERTY_STYLE,
+        tooltip=folium.GeoJsonTooltip(
+            fields=["Planning Area", "Subzone", "cluster"],
+            aliases=["Planning Area: ", "Subzone: ", "Cluster: "],
+            style=(
+                "background-color: white; color: #333333; font-family: arial; font-size: 12px; padding: 10px;"
+            ),
         ),
     ),
 )
+register_layer("cluster_colormap", lambda colormap=color_step: colormap)
 
-cluster_gj.add_to(m5)
-plan_border.add_to(m5)
-color_step.add_to(m5)
+m5 = map_views["clusters"] = MapView("clusters", "plan_border", "cluster_colormap")
 
 m5
 
 # %%
 # Plot Bubble Tea locations
 # Other Bubble Tea Outlets from Foursquare API
-m6 = folium.Map(location=[1.3521, 103.8198], tiles="cartodbpositron", zoom_start=11)
-
-cluster_gj.add_to(m6)
-plan_border.add_to(m6)
-color_step.add_to(m6)
-
-for index, row in boba_df.iterrows():
-    lat = row["location.lat"]
-    lng = row["location.lng"]
-    name = row["name"]
-
-    folium.CircleMarker(
-        location=[lat, lng],
-        radius=3,
-        weight=0,
-        popup=name,
-        color="Black",
-        fill_color="Blue",
-        fill_opacity=0.5,
-    ).add_to(m6)
-
-# Adding Xing Fu Tang Location
-for lat, lng, add in zip(xft_lat, xft_lng, xft_add):
-    folium.CircleMarker(
-        location=[lat, lng],
-        radius=5,
-        weight=2,
-        popup="Xing Fu Tang @ {}".format(add),
-        color="Black",
-        fill_color="Red",
-        fill_opacity=1,
-    ).add_to(m6)
-
-m6.get_root().add_child(bubble_macro)  # Adding legend
+m6 = map_views["cluster_bubble_tea"] = MapView(
+    "clusters", "plan_border", "cluster_colormap", "boba", "xft", "bubble_legend",
+)
 
 m6
 # %%
 # Plot MRT and Shopping Mall Location
-m7 = folium.Map(location=[1.3521, 103.8198], tiles="cartodbpositron", zoom_start=11)
-
-cluster_gj.add_to(m7)
-plan_border.add_to(m7)
-color_step.add_to(m7)
-
 # MRT Locations
-for index, row in mrt_df.iterrows():
-    lat = row["lat"]
-    lng = row["lng"]
-    name = row["station_name"]
-
-    folium.CircleMarker(
-        location=[lat, lng],
+mrt_points = point_features(mrt_df["lat"], mrt_df["lng"], mrt_df["station_name"])
+register_layer(
+    "mrt",
+    lambda features=mrt_points: point_layer(
+        features,
+        name="MRT Stations",
         radius=3,
         weight=1,
-        popup=name,
         color="black",
         fill_color="#00FF00",
         fill_opacity=1,
-    ).add_to(m7)
+    ),
+)
 
 # Shopping Mall locations from Foursquare API
-for index, row in mall_df.iterrows():
-    lat = row["location.lat"]
-    lng = row["location.lng"]
-    name = row["name"]
-
-    folium.CircleMarker(
-        location=[lat, lng],
+mall_points = point_features(
+    mall_df["location.lat"], mall_df["location.lng"], mall_df["name"]
+)
+register_layer(
+    "malls",
+    lambda features=mall_points: point_layer(
+        features,
+        name="Shopping Malls",
         radius=3,
         weight=1,
-        popup=name,
         color="Black",
         fill_color="#FF00FF",
         fill_opacity=1,
-    ).add_to(m7)
+    ),
+)
 
-m7.get_root().add_child(mrt_mall_macro)  # Adding legend
+m7 = map_views["cluster_mrt_mall"] = MapView(
+    "clusters", "plan_border", "cluster_colormap", "mrt", "malls", "mrt_mall_legend",
+)
 
 m7
 # %%
 # Scoring each feature to get cluster score
-# MRT/Mall weighted scoring
-bt_per_mrt = int(input("Enter your estimate of # of Bubble Tea Shop per MRT Station: "))
+# MRT/Mall weighted scoring (BT_PER_MRT and BT_PER_MALL skip the prompts in headless runs)
+bt_per_mrt = int(
+    os.getenv("BT_PER_MRT")
+    or input("Enter your estimate of # of Bubble Tea Shop per MRT Station: ")
+)
 bt_per_mall = int(
-    input("Enter your estimate of # of Bubble Tea Shop per Shopping Mall: ")
+    os.getenv("BT_PER_MALL")
+    or input("Enter your estimate of # of Bubble Tea Shop per Shopping Mall: ")
 )
 
 cluster_geodf["mrt_mall_score"] = (
@@ -1384,71 +2761,150 @@ other_select_sub_geodf = select_sub_geodf[
 ].dropna()
 # %%
 # Plot selected Subzones on map
-m8 = folium.Map(location=[1.3521, 103.8198], tiles="cartodbpositron", zoom_start=11)
-
 # All Subzones
-folium.GeoJson(
-    cluster_geodf,
-    name="Other Clusters",
-    style_function=lambda x: {
-        "fillColor": "White",
-        "color": "Grey",
-        "fillOpacity": 0.1,
-        "weight": 0.7,
-    },
-    highlight_function=highlight_function,
-    tooltip=folium.GeoJsonTooltip(
-        fields=["Subzone", "Planning Area", "cluster", "subzone_score"],
-        aliases=["Subzone: ", "Planning Area: ", "Cluster: ", "Subzone Score: "],
-        style=(
-            "background-color: white; color: #333333; font-family: arial; font-size: 12px; padding: 10px;"
+register_layer(
+    "other_clusters",
+    lambda geodf=cluster_geodf.copy(): boundary_layer(
+        geodf,
+        name="Other Clusters",
+        style={
+            "fillColor": "White",
+            "color": "Grey",
+            "fillOpacity": 0.1,
+            "weight": 0.7,
+        },
+        highlight_function=highlight_function,
+        tooltip=folium.GeoJsonTooltip(
+            fields=["Subzone", "Planning Area", "cluster", "subzone_score"],
+            aliases=["Subzone: ", "Planning Area: ", "Cluster: ", "Subzone Score: "],
+            style=(
+                "background-color: white; color: #333333; font-family: arial; font-size: 12px; padding: 10px;"
+            ),
         ),
     ),
-).add_to(m8)
+)
 
 # All selected Subzone Boundaries
-folium.GeoJson(
-    other_select_sub_geodf,
-    name="Cluster {} Subzone Borders".format(top_cluster),
-    style_function=lambda x: {
-        "fillColor": "#AEDE74",
-        "color": "Grey",
-        "fillOpacity": 0.8,
-        "weight": 0.7,
-    },
-    highlight_function=highlight_function,
-    tooltip=folium.GeoJsonTooltip(
-        fields=["Subzone", "Planning Area", "cluster", "subzone_score"],
-        aliases=["Subzone: ", "Planning Area: ", "Cluster: ", "Subzone Score: "],
-        style=(
-            "background-color: white; color: #333333; font-family: arial; font-size: 12px; padding: 10px;"
+register_layer(
+    "selected_subzones",
+    lambda geodf=other_select_sub_geodf.copy(), top_cluster=top_cluster: boundary_layer(
+        geodf,
+        name="Cluster {} Subzone Borders".format(top_cluster),
+        style={
+            "fillColor": "#AEDE74",
+            "color": "Grey",
+            "fillOpacity": 0.8,
+            "weight": 0.7,
+        },
+        highlight_function=highlight_function,
+        tooltip=folium.GeoJsonTooltip(
+            fields=["Subzone", "Planning Area", "cluster", "subzone_score"],
+            aliases=["Subzone: ", "Planning Area: ", "Cluster: ", "Subzone Score: "],
+            style=(
+                "background-color: white; color: #333333; font-family: arial; font-size: 12px; padding: 10px;"
+            ),
         ),
     ),
-).add_to(m8)
+)
 
 # Top 5 Subzone Boundaries
-folium.GeoJson(
-    top5_sub_geodf,
-    name="Cluster {} Subzone Borders".format(top_cluster),
-    style_function=lambda x: {
-        "fillColor": "#0E7D74",
-        "color": "Grey",
-        "fillOpacity": 0.8,
-        "weight": 0.7,
-    },
-    highlight_function=highlight_function,
-    tooltip=folium.GeoJsonTooltip(
-        fields=["Subzone", "Planning Area", "cluster", "subzone_score"],
-        aliases=["Subzone: ", "Planning Area: ", "Cluster: ", "Subzone Score: "],
-        style=(
-            "background-color: white; color: #333333; font-family: arial; font-size: 12px; padding: 10px;"
+register_layer(
+    "top5_subzones",
+    lambda geodf=top5_sub_geodf.copy(), top_cluster=top_cluster: boundary_layer(
+        geodf,
+        name="Cluster {} Subzone Borders".format(top_cluster),
+        style={
+            "fillColor": "#0E7D74",
+            "color": "Grey",
+            "fillOpacity": 0.8,
+            "weight": 0.7,
+        },
+        highlight_function=highlight_function,
+        tooltip=folium.GeoJsonTooltip(
+            fields=["Subzone", "Planning Area", "cluster", "subzone_score"],
+            aliases=["Subzone: ", "Planning Area: ", "Cluster: ", "Subzone Score: "],
+            style=(
+                "background-color: white; color: #333333; font-family: arial; font-size: 12px; padding: 10px;"
+            ),
         ),
     ),
-).add_to(m8)
-
-# Planning Area Boundaries
-plan_border.add_to(m8)
+)
 
-m8.get_root().add_child(selected_sub_macro)  # Adding legend
+m8 = map_views["selected_subzones"] = MapView(
+    "other_clusters",
+    "selected_subzones",
+    "top5_subzones",
+    "plan_border",
+    "selected_sub_legend",
+)
 
 m8
+
+# %%
+# Headless Map Export
+# Renders every view in map_views to MAP_EXPORT_DIR/<view>.html in a process pool, e.g.
+# MAP_EXPORT_DIR=maps BT_PER_MRT=2 BT_PER_MALL=3 ipython "Battle of the Neighbourhoods (Singapore).py"
+# Shared layers are built once in this process and inherited by the forked workers, which
+# only render (on Linux; elsewhere forking after GUI libraries have loaded is unsafe, so views
+# are rendered serially). Render time, size and any error of each map are written to
+# MAP_EXPORT_DIR/export_times.csv
+# Maps go next to their shared assets in export mode, so that asset urls resolve
+MAP_EXPORT_DIR = MAP_ASSET_DIR or os.getenv("MAP_EXPORT_DIR")
+MAP_EXPORT_WORKERS = int(os.getenv("MAP_EXPORT_WORKERS") or os.cpu_count())
+
+
+def export_view(view_name, out_dir):
+    """Saves one map view to out_dir, returning its name, render time (seconds), size (bytes) and error (None on success)"""
+    path = os.path.join(out_dir, view_name + ".html")
+    start = time.perf_counter()
+    try:
+        map_views[view_name].save(path)
+    except Exception as e:
+        # Not leaving a partial map behind
+        if os.path.exists(path):
+            os.remove(path)
+        return view_name, time.perf_counter() - start, None, repr(e)
+
+    return view_name, time.perf_counter() - start, os.path.getsize(path), None
+
+
+def export_views(out_dir, workers=MAP_EXPORT_WORKERS):
+    """Saves all map views to out_dir, in parallel on Linux, returning and writing their export times"""
+    os.makedirs(out_dir, exist_ok=True)
+    for view in map_views.values():
+        for name in view.layers:
+            get_layer(name)
+
+    # Workers need the notebook state, so they are forked
+    if sys.platform.startswith("linux"):
+        context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(workers, mp_context=context) as executor:
+            futures = {
+                view_name: executor.submit(export_view, view_name, out_dir)
+                for view_name in map_views
+            }
+            rows = []
+            for view_name, future in futures.items():
+                try:
+                    rows.append(future.result())
+                except Exception as e:  # Worker died, e.g. BrokenProcessPool
+                    rows.append((view_name, None, None, repr(e)))
+    else:
+        rows = [export_view(view_name, out_dir) for view_name in map_views]
+
+    times_df = pd.DataFrame(rows, columns=["view", "seconds", "bytes", "error"])
+    times_df.to_csv(os.path.join(out_dir, "export_times.csv"), index=False)
+    return times_df
+
+
+if MAP_EXPORT_DIR:
+    start = time.perf_counter()
+    export_times_df = export_views(MAP_EXPORT_DIR)
+    print(
+        "Exported {} maps in {:.1f}s, {} failed".format(
+            export_times_df["error"].isna().sum(),
+            time.perf_counter() - start,
+            export_times_df["error"].notna().sum(),
+        )
+    )
+    print(export_times_df)